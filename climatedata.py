@@ -12,37 +12,93 @@ import gzip
 import pickle
 import os
 import data_processing
+import file_handling
 
 DATA_DIRECTORY = "/Users/eabarnes/big_data/"
 PROCESSED_DIRECTORY = "processed_data/"
 
+# settings that change the processed climate data
+CLIMATE_SETTINGS_KEYS = (
+    "gcm",
+    "n_members",
+    "data_years",
+    "baseline_years",
+    "avg_frequency",
+    "response_type",
+    "var_list",
+    "response_year_range",
+    "window_len",
+    "response_tail",
+    "response_threshold",
+    "growing_season_only",
+    "product",
+)
+
 
 def get_climate_data(settings, rewrite, save):
-    if settings["presaved_processed_data"] is None:
-        filename = PROCESSED_DIRECTORY + settings["exp_name"] + "_processed_data.nc"
-    else:
-        filename = PROCESSED_DIRECTORY + settings["presaved_processed_data"]
+    filename = get_climate_data_filename(settings)
 
-    if os.path.exists(filename) and not rewrite:
+    if file_handling.is_cache_current(filename) and not rewrite:
         print(filename + ": loading saved data.")
+        file_handling.touch_cache(filename)
         data = xr.open_dataarray(filename)
+        if settings["response_type"] == "extremes" and data.dtype != np.int8:
+            # older caches stored the categories as float64. Anomalies stay as they are.
+            data = data.fillna(0).astype(np.int8)
     else:
         data = data_processing.build_response_data(settings, DATA_DIRECTORY)
         if save:
             data.to_netcdf(filename)
+            file_handling.register_cache(
+                filename,
+                settings,
+                settings.get("cache_budget_bytes", file_handling.CACHE_BUDGET_BYTES),
+                input_files=get_climate_input_files(settings),
+            )
 
     # STACK THE DATA (members x windows) INTO SAMPLES
     # the stacked data cannot be serialized, so we do this after the fact.
     data = data.stack(sample=("member", "window")).transpose("sample", "lat", "lon")
     print(f"final samples.shape = {data.shape}")
 
-    # convert to hot-wet and hot-dry
-    data_hotdry = xr.where(data == 1, 1.0, 0.0)
-    data_hotwet = xr.where(data == 2, 1.0, 0.0)
+    # convert to hot-wet and hot-dry, kept as int8 flags until they are aggregated
+    data_hotdry = (data == 1).astype(np.int8)
+    data_hotwet = (data == 2).astype(np.int8)
 
     return data_hotwet, data_hotdry
 
 
+def get_climate_data_filename(settings):
+    # cached data is keyed on the settings it was computed with. The member files are
+    # only checked where they are present, see file_handling.is_cache_current.
+    if settings["presaved_processed_data"] is None:
+        return file_handling.get_cache_filename(
+            PROCESSED_DIRECTORY,
+            settings,
+            CLIMATE_SETTINGS_KEYS,
+            "_processed_data.nc",
+        )
+    return PROCESSED_DIRECTORY + settings["presaved_processed_data"]
+
+
+def get_climate_input_files(settings):
+    # member files of every variable, and the crop calendars of the growing season mask
+    input_files = []
+    for var in settings["var_list"]:
+        for filenames in file_handling.get_member_filenames(
+            dict(settings, var=var), DATA_DIRECTORY
+        ):
+            input_files += list(filenames)
+    if settings["growing_season_only"]:
+        input_files += [
+            filename
+            for filename in data_processing.get_growing_seasons_filenames(settings)
+            if filename is not None
+        ]
+
+    return input_files
+
+
 def get_reanalysis_baseline(settings, data_like=None):
 
     data_baseline = data_processing.compute_reanalysis_baseline(
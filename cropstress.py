@@ -8,11 +8,16 @@ Functions
 import numpy as np
 import pandas as pd
 import xarray as xr
+import scipy.sparse as sparse
+import scipy.sparse.linalg
 import os
+import concurrent.futures
 
 import data_processing
 import metrics
 import file_handling
+import climatedata
+import experiment_settings
 
 DATA_DIRECTORY = "/Users/eabarnes/big_data/"
 GTAP_DATA_DIRECTORY = "data/GTAP_data/"
@@ -21,6 +26,20 @@ SHAPE_DIRECTORY = "shapefiles/gadm_shapefiles_20230301_gtapv11/"
 CROP_DIRECTORY = "data/cropgrid/processed_crops/"
 PROCESSED_METRICS_DIRECTORY = "processed_metrics/"
 
+# settings that change the processed metrics, on top of the climate data settings
+METRICS_SETTINGS_KEYS = climatedata.CLIMATE_SETTINGS_KEYS + (
+    "gtap_filename",
+    "trade_data_year",
+    "include_self",
+    "exclude_regions",
+)
+
+# memory of one [scenario, reporter, sample, partner] tensor when sizing the batches of
+# compute_trade_scenarios. A few tensors of this size are alive at once.
+SCENARIO_BATCH_BYTES = 512 * 1024**2
+
+_TRADE_CUBES = {}
+
 
 def crop_name(product):
     if product == "pdr":
@@ -57,12 +76,11 @@ def replace_zeros(x, fill_value=np.nan):
 
 
 def get_processed_metrics(data_hotwet, data_hotdry, settings, rewrite=False, save=True, calories=False):
-    metrics_savename = (
-        PROCESSED_METRICS_DIRECTORY + settings["exp_name"] + "_processed_metrics.pickle"
-    )
+    metrics_savename = get_metrics_filename(settings)
 
-    if os.path.isfile(metrics_savename) and not rewrite:
+    if file_handling.is_cache_current(metrics_savename) and not rewrite:
         print(f"   loading pre-saved data from {metrics_savename}")
+        file_handling.touch_cache(metrics_savename)
         (
             reporter_code_list,
             traded_stress,
@@ -78,7 +96,10 @@ def get_processed_metrics(data_hotwet, data_hotdry, settings, rewrite=False, sav
             unweighted_stress,
             df_stress,
             df_metrics,
-        ) = compute_cropstress_trade(data_hotwet, data_hotdry, settings)
+            partner_code_list,
+        ) = compute_cropstress_trade(
+            data_hotwet, data_hotdry, settings, rewrite=rewrite, save=save
+        )
 
         # save the data
         if save:
@@ -90,6 +111,13 @@ def get_processed_metrics(data_hotwet, data_hotdry, settings, rewrite=False, sav
                 unweighted_stress,
                 df_stress,
                 df_metrics,
+                partner_code_list=partner_code_list,
+            )
+            file_handling.register_cache(
+                metrics_savename,
+                settings,
+                settings.get("cache_budget_bytes", file_handling.CACHE_BUDGET_BYTES),
+                input_files=get_metrics_input_files(settings),
             )
 
     return (
@@ -101,35 +129,296 @@ def get_processed_metrics(data_hotwet, data_hotdry, settings, rewrite=False, sav
     )
 
 
-def get_trade_data(settings, convert_to_calories=False):
-    # GET TRADE DATA
-    assert (
-        settings["trade_data_year"] == 2017
-    ), "we only have data for 2017 from GTAPv11"
+def get_metrics_filename(settings):
+    # cached metrics are keyed on the settings, the trade csv and the fingerprint of the
+    # partner responses they were computed from. trade_hops only enters the key when set,
+    # so the single-hop caches keep their names.
+    keys = METRICS_SETTINGS_KEYS
+    if settings.get("trade_hops", 1) != 1:
+        keys = keys + ("trade_hops",)
+    return file_handling.get_cache_filename(
+        PROCESSED_METRICS_DIRECTORY,
+        settings,
+        keys,
+        "_processed_metrics",
+        inputs=[
+            GTAP_DATA_DIRECTORY + settings["gtap_filename"],
+            os.path.basename(get_partner_response_filename(settings)),
+        ],
+    )
 
-    print("reading trade data: " + GTAP_DATA_DIRECTORY + settings["gtap_filename"])
-    data_trade = pd.read_csv(GTAP_DATA_DIRECTORY + settings["gtap_filename"])
-    data_trade = pd.DataFrame(data_trade.fillna(0))
 
-    # grab product of interest
-    if (settings["product"] != "all") & (settings["product"] != "calories"):
-        data_trade = data_trade[
-            data_trade["COMM"].isin(
-                [
-                    settings["product"],
-                ]
+def run_subexperiment(experiment_name, rewrite=False, save=True, prune=True):
+    # processed metrics of one experiment, only loading the climate data if neither the
+    # metrics nor the partner responses are cached. Without prune, the saved caches are
+    # registered but nothing is evicted.
+    settings = experiment_settings.get_settings(experiment_name)
+    if not prune:
+        settings["cache_budget_bytes"] = None
+    if not rewrite and (
+        file_handling.is_cache_current(get_metrics_filename(settings))
+        or file_handling.is_cache_current(get_partner_response_filename(settings))
+    ):
+        data_hotwet, data_hotdry = None, None
+    else:
+        data_hotwet, data_hotdry = climatedata.get_climate_data(
+            settings, rewrite=rewrite, save=save
+        )
+
+    return get_processed_metrics(
+        data_hotwet, data_hotdry, settings, rewrite=rewrite, save=save
+    )
+
+
+def run_subexperiments(settings, workers=None, rewrite=False, save=True):
+    # runs the subexperiments of an aggregate experiment (e.g. the four crops of exp600)
+    # in a process pool. The trade cube, country masks and regions are loaded once here
+    # and handed to every worker, and the results are returned by subexperiment, in order.
+    # The caches are only pruned once all workers are done, so no worker evicts a file
+    # another one is still reading.
+    subexperiments = settings["subexperiments"]
+    if workers is None:
+        workers = len(subexperiments)
+
+    get_trade_cube(settings)
+    data_processing.get_country_masks(settings, SHAPE_DIRECTORY, DATA_DIRECTORY)
+
+    if workers <= 1:
+        result_list = [
+            run_subexperiment(subexp, rewrite, save, prune=False)
+            for subexp in subexperiments
+        ]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=set_shared_inputs,
+            initargs=(_TRADE_CUBES,) + data_processing.get_region_caches(),
+        ) as executor:
+            result_list = list(
+                executor.map(
+                    run_subexperiment,
+                    subexperiments,
+                    [rewrite] * len(subexperiments),
+                    [save] * len(subexperiments),
+                    [False] * len(subexperiments),
+                )
             )
-        ].reset_index(drop=True)
-    # print(data_trade.head())
+
+    if save:
+        max_bytes = settings.get("cache_budget_bytes", file_handling.CACHE_BUDGET_BYTES)
+        for directory in {climatedata.PROCESSED_DIRECTORY, PROCESSED_METRICS_DIRECTORY}:
+            if os.path.isdir(directory):
+                file_handling.prune_cache(directory, max_bytes)
+
+    return dict(zip(subexperiments, result_list))
+
+
+def set_shared_inputs(trade_cubes, country_masks, regions):
+    _TRADE_CUBES.update(trade_cubes)
+    data_processing.set_region_caches(country_masks, regions)
+
+
+def combine_subexperiments(results):
+    # combines the traded_stress of the subexperiments, weighted by each reporter's
+    # imported calories of every crop. Also returns each crop's fraction of the
+    # reporter's imported calories, [crop, reporter].
+    traded_stress_calories = 0.0
+    import_calories = []
+    for subexp, (reporter_code_list, traded_stress, __, __, __) in results.items():
+        pass_settings = experiment_settings.get_settings(subexp)
+        trade_matrix = get_trade_data(
+            pass_settings, convert_to_calories=True, return_matrix=True
+        )[3]
+        import_calories.append(trade_matrix.sum(axis=-1))
+        traded_stress_calories = (
+            traded_stress_calories
+            + traded_stress * import_calories[-1][:, np.newaxis, np.newaxis]
+        )
+
+    import_calories = np.stack(import_calories)
+    import_calories_sum = import_calories.sum(axis=0)
+
+    return (
+        reporter_code_list,
+        traded_stress_calories / import_calories_sum[:, np.newaxis, np.newaxis],
+        import_calories / import_calories_sum,
+    )
+
+
+def get_trade_cube(settings):
+    # [commodity, source, destination] trade values of the GTAP csv with integer-coded
+    # axes, built once per process from its binary sidecar. present marks the pairs that
+    # are listed in the csv.
+    filename = GTAP_DATA_DIRECTORY + settings["gtap_filename"]
+    if filename not in _TRADE_CUBES:
+        print("reading trade data: " + filename)
+        records = file_handling.load_trade_records(filename)
+        commodity_list = records["commodity_list"]
+        region_list = records["region_list"]
+        icommodity, isource, idestination = (
+            records["icommodity"],
+            records["isource"],
+            records["idestination"],
+        )
+
+        shape = (len(commodity_list), len(region_list), len(region_list))
+        values = np.zeros(shape)
+        np.add.at(values, (icommodity, isource, idestination), records["values"])
+        present = np.zeros(shape, dtype=bool)
+        present[icommodity, isource, idestination] = True
+
+        _TRADE_CUBES[filename] = {
+            "commodity_list": commodity_list,
+            "region_list": region_list,
+            "values": values,
+            "present": present,
+        }
+
+    return _TRADE_CUBES[filename]
+
+
+def get_commodity_weights(commodity_list, product, convert_to_calories=False):
+    # weight of every commodity in the product of interest, in dollars or calories
+    if (product != "all") & (product != "calories"):
+        weights = (commodity_list == product).astype(float)
+    else:
+        weights = np.ones(len(commodity_list))
 
     if convert_to_calories:
-        for product in ("gro", "osd", "wht", "pdr"):
-            data_trade.loc[data_trade["COMM"] == product, "TotValue"] = (
-                data_trade.TotValue * get_nutritive_factors(product)
+        for icommodity, commodity in enumerate(commodity_list):
+            if commodity in ("gro", "osd", "wht", "pdr"):
+                weights[icommodity] *= get_nutritive_factors(commodity)
+
+    return weights
+
+
+def get_trade_view(cube, product, convert_to_calories=False):
+    # [source, destination] trade of the product of interest, in dollars or calories,
+    # along with the sources and destinations it lists
+    weights = get_commodity_weights(
+        cube["commodity_list"], product, convert_to_calories
+    )
+    trade = np.tensordot(weights, cube["values"], axes=1)
+
+    present = cube["present"][weights != 0].any(axis=0)
+    isource = np.where(present.any(axis=1))[0]
+    idestination = np.where(present.any(axis=0))[0]
+
+    return (
+        trade[np.ix_(isource, idestination)],
+        cube["region_list"][isource],
+        cube["region_list"][idestination],
+    )
+
+
+def get_metrics_input_files(settings):
+    # files recorded with the cached metrics, see file_handling.is_cache_current
+    return [GTAP_DATA_DIRECTORY + settings["gtap_filename"]] + get_response_input_files(
+        settings
+    )
+
+
+def get_response_input_files(settings):
+    # files recorded with the cached partner responses. The processed climate data is
+    # not among them, it enters through its fingerprint in the key.
+    input_files = [SHAPE_DIRECTORY + "countries_10m_" + settings["gcm"] + ".nc"]
+    if settings["product"] not in ("all", "calories"):
+        input_files += [
+            data_processing.get_cropped_area_filename(
+                CROP_DIRECTORY, settings, include_irrigated=include_irrigated
+            )
+            for include_irrigated in (True, False)
+        ]
+
+    return input_files
+
+
+def get_partner_response(data_hotwet, data_hotdry, settings, rewrite=False, save=True):
+    # [region, sample] hot-wet and hot-dry crop responses of every shapefile region. They
+    # only depend on the climate data, masks and crop areas, so they are cached apart from
+    # the trade weighting and the climate data is only needed to compute them.
+    filename = get_partner_response_filename(settings)
+
+    if file_handling.is_cache_current(filename) and not rewrite:
+        print(f"   loading partner responses from {filename}")
+        file_handling.touch_cache(filename)
+        with np.load(filename) as f:
+            return f["region_code_list"], f["response_hotwet"], f["response_hotdry"]
+    if data_hotwet is None or data_hotdry is None:
+        raise ValueError(
+            f"no cached partner responses {filename}, the climate data is needed"
+        )
+
+    # get masks
+    mask_country, regs_shp = data_processing.get_country_masks(
+        settings, SHAPE_DIRECTORY, DATA_DIRECTORY
+    )
+    region_code_list = np.unique(regs_shp["REG"].values.astype(str))
+
+    # get cropped area
+    da_crop_area = data_processing.get_cropped_area_mask(CROP_DIRECTORY, settings, include_irrigated=True)
+    da_crop_unirr_area = data_processing.get_cropped_area_mask(CROP_DIRECTORY, settings, include_irrigated=False)
+
+    # crop responses for all samples at once, over cropped area only
+    weights_irr, weights_unirr = data_processing.get_region_crop_weights(
+        region_code_list, regs_shp, mask_country, da_crop_area, da_crop_unirr_area
+    )
+    response_hotwet = data_processing.compute_region_sums(weights_irr, data_hotwet)
+    response_hotdry = data_processing.compute_region_sums(weights_unirr, data_hotdry)
+
+    if save:
+        print(f"   saving partner responses to {filename}")
+        with open(filename + ".tmp", "wb") as fp:
+            np.savez(
+                fp,
+                region_code_list=region_code_list,
+                response_hotwet=response_hotwet,
+                response_hotdry=response_hotdry,
             )
+        os.replace(filename + ".tmp", filename)
+        file_handling.register_cache(
+            filename,
+            settings,
+            settings.get("cache_budget_bytes", file_handling.CACHE_BUDGET_BYTES),
+            input_files=get_response_input_files(settings),
+        )
 
-    data_trade = (
-        data_trade.groupby(by=["Source", "Destination"]).sum("TotValue").reset_index()
+    return region_code_list, response_hotwet, response_hotdry
+
+
+def get_partner_response_filename(settings):
+    # keyed on the climate settings, the fingerprint of the climate data and the mask and
+    # crop area files. Evicting or rewriting the climate data keeps the key.
+    return file_handling.get_cache_filename(
+        PROCESSED_DIRECTORY,
+        settings,
+        climatedata.CLIMATE_SETTINGS_KEYS,
+        "_partner_response.npz",
+        inputs=[os.path.basename(climatedata.get_climate_data_filename(settings))]
+        + get_response_input_files(settings),
+    )
+
+
+def get_trade_data(settings, convert_to_calories=False, return_matrix=False):
+    # GET TRADE DATA
+    assert (
+        settings["trade_data_year"] == 2017
+    ), "we only have data for 2017 from GTAPv11"
+
+    trade, partner_code_list, destination_code_list = get_trade_view(
+        get_trade_cube(settings), settings["product"], convert_to_calories
+    )
+
+    # every reporter lists the same partners, with zero trade for pairs not in the csv
+    source, destination = np.meshgrid(
+        partner_code_list, destination_code_list, indexing="ij"
+    )
+    data_trade = pd.DataFrame(
+        {
+            "Source": source.ravel(),
+            "Destination": destination.ravel(),
+            "TotValue": trade.ravel(),
+        }
     )
     if not settings["include_self"]:
         data_trade = data_trade[
@@ -148,127 +437,334 @@ def get_trade_data(settings, convert_to_calories=False):
 
     # print(data_trade.head())
 
+    if return_matrix:
+        # reporter x partner imports over the canonical partner_code_list
+        trade_matrix = trade.T[np.isin(destination_code_list, reporter_code_list)]
+        if not settings["include_self"]:
+            trade_matrix = np.where(
+                reporter_code_list[:, np.newaxis] == partner_code_list[np.newaxis, :],
+                0.0,
+                trade_matrix,
+            )
+        return data_trade, reporter_code_list, n_partners, trade_matrix, partner_code_list
+
     return data_trade, reporter_code_list, n_partners
 
 
-def compute_cropstress_trade(data_hotwet, data_hotdry, settings):
-    return compute_cropstress_trade_percentage(data_hotwet, data_hotdry, settings)
+def get_origin_shares(
+    trade_matrix, reporter_code_list, partner_code_list, settings, imports=None
+):
+    # fraction of each reporter's imports that originates from the crop production of each
+    # partner, following re-exports through settings["trade_hops"] hops of the trade
+    # network (or to convergence with "converge"). One hop, the default, gives the
+    # bilateral import shares. Excluded partners still count towards the total imports,
+    # but carry no share of the stress. Beyond one hop the excluded regions are passed
+    # through as re-export hubs, but their own production still carries no share either.
+    # trade_matrix may have leading (scenario) axes, and imports are the [..., reporter]
+    # totals the shares are taken of, by default the sum over the partners.
+    if imports is None:
+        imports = np.sum(trade_matrix, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        origin_shares = trade_matrix / imports[..., np.newaxis]
+
+    hops = settings.get("trade_hops", 1)
+    if hops != 1:
+        # what a partner exports is a mix of its own production and of its own imports
+        composition = propagate_origin_shares(
+            get_supply_shares(settings, partner_code_list),
+            None if hops == "converge" else hops - 1,
+        )
+        is_self = reporter_code_list[:, np.newaxis] == partner_code_list[np.newaxis, :]
+        own_shares = np.where(is_self, origin_shares, 0.0)
+        origin_shares = own_shares + (origin_shares - own_shares) @ composition
+        if not settings["include_self"]:
+            # own production coming back through re-exports is dropped as well, keeping
+            # the total share of every reporter
+            total = np.sum(origin_shares, axis=-1, keepdims=True)
+            origin_shares = np.where(is_self, 0.0, origin_shares)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                origin_shares *= total / np.sum(origin_shares, axis=-1, keepdims=True)
+    origin_shares[..., np.isin(partner_code_list, settings["exclude_regions"])] = 0.0
+
+    return origin_shares
+
+
+def get_supply_shares(settings, partner_code_list):
+    # sparse [region, region] fraction of each region's supply (own production and
+    # imports) coming from each region, over partner_code_list. Regions without imports
+    # in the csv are taken to supply only themselves.
+    trade, source_code_list, destination_code_list = get_trade_view(
+        get_trade_cube(settings), settings["product"]
+    )
+    supply = np.zeros((len(partner_code_list), len(partner_code_list)))
+    isource = np.searchsorted(partner_code_list, source_code_list)
+    is_partner = np.isin(destination_code_list, partner_code_list)
+    idestination = np.searchsorted(
+        partner_code_list, destination_code_list[is_partner]
+    )
+    supply[np.ix_(idestination, isource)] = trade[:, is_partner].T
 
+    no_supply = np.sum(supply, axis=-1) == 0
+    supply[no_supply, no_supply] = 1.0
 
-def compute_cropstress_trade_percentage(data_hotwet, data_hotdry, settings):
-    # get trade data
-    data_trade, reporter_code_list, n_partners = get_trade_data(settings)
+    return sparse.csr_matrix(supply / np.sum(supply, axis=-1, keepdims=True))
 
-    # get masks
-    mask_country, regs_shp = data_processing.get_country_masks(
-        settings, SHAPE_DIRECTORY, DATA_DIRECTORY
+
+def propagate_origin_shares(supply_shares, hops=None):
+    # [region, origin] composition M of every region's supply when re-exports are followed
+    # for hops hops, with D the own production shares and A the import shares of
+    # supply_shares: M = I, then M = D + A M for every hop. hops=None solves
+    # (I - A) M = D for the converged composition.
+    own = sparse.diags(supply_shares.diagonal())
+    imports = (supply_shares - own).tocsr()
+    identity = sparse.identity(supply_shares.shape[0], format="csr")
+
+    if hops is None:
+        composition = scipy.sparse.linalg.spsolve(
+            (identity - imports).tocsc(), own.tocsc()
+        )
+    else:
+        composition = identity
+        for __ in range(hops):
+            composition = own + imports @ composition
+
+    if sparse.issparse(composition):
+        return composition.toarray()
+    return np.asarray(composition)
+
+
+def compute_cropstress_trade(
+    data_hotwet, data_hotdry, settings, rewrite=False, save=True
+):
+    return compute_cropstress_trade_percentage(
+        data_hotwet, data_hotdry, settings, rewrite=rewrite, save=save
     )
 
-    # get cropped area
-    da_crop_area = data_processing.get_cropped_area_mask(CROP_DIRECTORY, settings, include_irrigated=True)
-    da_crop_unirr_area = data_processing.get_cropped_area_mask(CROP_DIRECTORY, settings, include_irrigated=False)
 
-    # Initalize arrays and maps
-    traded_stress = (
-        np.zeros((len(reporter_code_list), np.shape(data_hotwet)[0], n_partners)) * np.nan
+def compute_cropstress_trade_percentage(
+    data_hotwet, data_hotdry, settings, rewrite=False, save=True
+):
+    # the trade-weighted stress of every reporter, and the partner codes of its last axis
+    # get trade data
+    (
+        data_trade,
+        reporter_code_list,
+        n_partners,
+        trade_matrix,
+        partner_code_list,
+    ) = get_trade_data(settings, return_matrix=True)
+    trade_shares = get_origin_shares(
+        trade_matrix, reporter_code_list, partner_code_list, settings
     )
-    unweighted_stress = (
-        np.zeros((len(reporter_code_list), np.shape(data_hotwet)[0], n_partners)) * np.nan
+
+    # partner crop responses for all samples at once, over cropped area only
+    partner_response = get_partner_stress(
+        data_hotwet, data_hotdry, partner_code_list, settings, rewrite, save
     )
 
-    # START THE LOOP THROUGH REPORTERS
-    reporter_code_summary = []
-    metrics_dict = {}
-    stress_dict = {}
+    # WEIGHT THE PARTNER RESPONSES BY TRADE, [reporter, sample, partner]
+    # partners with no trade (or excluded) and partners without a response are nan
+    partner_response = partner_response.T[np.newaxis, :, :]
+    has_stress = (trade_shares[:, np.newaxis, :] != 0) & ~np.isnan(partner_response)
+    unweighted_stress = np.where(has_stress, partner_response, np.nan)
+    traded_stress = unweighted_stress * trade_shares[:, np.newaxis, :]
+
+    # SUMMARIZING METRICS FOR ALL REPORTERS
+    total_stress = np.nansum(traded_stress, axis=-1)
+    df_metrics = metrics.compute_reporter_metrics(
+        traded_stress, trade_matrix, reporter_code_list, partner_code_list
+    )
 
     for irep, reporter_code in enumerate(reporter_code_list):
-        # GET REPORTER DATA
-        data_reporter = data_trade[data_trade["Destination"] == reporter_code]
-
-        reporter_name = data_processing.get_name_from_code(
-            (data_reporter["Destination"].values[0],)
-        )
-        reporter_import_dollars = data_reporter["TotValue"].sum()
-        reporter_code_summary.append(reporter_code)
+        reporter_name = data_processing.get_name_from_code((reporter_code,))
+        dollars = trade_matrix[irep, :]
+        corr_localimports, corr_toptwo = df_metrics.loc[
+            reporter_code, ["corr_localtotal", "corr_toptwo"]
+        ]
         print(
-            f"{reporter_code}, {reporter_name}, ${reporter_import_dollars:.3f},",
+            f"{reporter_code}, {reporter_name}, ${np.sum(dollars):.3f},",
             end=" ",
             flush=True,
         )
-
-        # GET PARTNER NAMES and DOLLARS
-        dollars = data_reporter["TotValue"].values
-        partner_code_list = data_reporter["Source"].values
-        print(f"n_partners = {len(np.unique(partner_code_list))},", end=" ", flush=True)
-        assert len(np.unique(partner_code_list)) == len(partner_code_list)
-
-        # COMPUTE QUANTITIES
-        for ip, partner_code in enumerate(partner_code_list):
-            # partner_name = data_processing.get_name_from_code((partner_code,))
-
-            if (
-                partner_code == reporter_code and not settings["include_self"]
-            ):  # do not look at the reporter itself (focused on imports)
-                raise ValueError("something is not right")
-
-            # compute trade fraction over the commodities of interest
-            partner_trade_frac = dollars[ip] / reporter_import_dollars
-            if partner_trade_frac == 0 or np.isin(
-                partner_code, settings["exclude_regions"]
-            ):
-                continue
-
-            # find partner in shapefile dataframe for geographic points
-            mask_partner = data_processing.create_country_mask(
-                partner_code, regs_shp, mask_country
-            )
-
-            # further mask the partner by cropped area
-            mask_partner_crop = mask_partner * da_crop_area
-            mask_partner_crop_unirr = mask_partner * da_crop_unirr_area
-
-            # RESPONSE CALCULATIONS ACROSS MAPS over CROP AREA ONLY
-            denominator = data_processing.compute_global_sum(mask_partner_crop)
-            crop_response_hotwet = data_processing.compute_global_sum(
-                data_hotwet
-                * mask_partner_crop
-                / denominator
-            )
-            crop_response_hotdry = data_processing.compute_global_sum(
-                data_hotdry
-                * mask_partner_crop_unirr
-                / denominator
-            )
-            crop_response = crop_response_hotwet + crop_response_hotdry
-            if np.isnan(crop_response[0]):
-                continue
-
-            traded_stress[irep, :, ip] = crop_response * partner_trade_frac
-            unweighted_stress[irep, :, ip] = crop_response
-
-        # SUMMARIZING METRICS
-        total_stress = np.nansum(traded_stress[irep, :, :], axis=-1)
-        corr_localimports = metrics.correlation_localimports(
-            traded_stress[irep, :, :], reporter_code, partner_code_list
-        )
-        corr_toptwo = metrics.correlation_toptwo(dollars, traded_stress[irep, :, :])
-
-        # FILL DICTIONARIES
-        stress_dict[reporter_code] = total_stress
-        metrics_dict[reporter_code] = {
-            "corr_localtotal": corr_localimports,
-            "corr_toptwo": corr_toptwo,
-        }
-
+        print(f"n_partners = {np.count_nonzero(dollars)},", end=" ", flush=True)
         print(f"{corr_localimports=:.2f}, {corr_toptwo=:.2f}", end="\n", flush=True)
 
     return (
         reporter_code_list,
         traded_stress,
         unweighted_stress,
-        pd.DataFrame(stress_dict).T,
-        pd.DataFrame(metrics_dict).T,
+        pd.DataFrame(total_stress, index=reporter_code_list),
+        df_metrics,
+        partner_code_list,
+    )
+
+
+def get_partner_stress(
+    data_hotwet, data_hotdry, partner_code_list, settings, rewrite=False, save=True
+):
+    # [partner, sample] combined hot-wet and hot-dry responses of partner_code_list, from
+    # the cached responses of all shapefile regions
+    region_code_list, response_hotwet, response_hotdry = get_partner_response(
+        data_hotwet, data_hotdry, settings, rewrite=rewrite, save=save
     )
+    ipartner = np.minimum(
+        np.searchsorted(region_code_list, partner_code_list), len(region_code_list) - 1
+    )
+    missing = region_code_list[ipartner] != partner_code_list
+    if np.any(missing):
+        raise NameError(f"no such regions {partner_code_list[missing]} in the shapefile")
+
+    return response_hotwet[ipartner] + response_hotdry[ipartner]
+
+
+def build_trade_scenarios(reporter_code_list, partner_code_list, scenarios):
+    # [scenario, reporter, partner] factors on the trade matrix, and whether each scenario
+    # reallocates the lost imports, from a list of dictionaries with
+    #   "remove": partners whose exports stop
+    #   "scale": {partner: factor} scaling of the exports of partners
+    #   "reporters": reporters the changes apply to (all by default)
+    #   "reallocate": reallocate the lost imports pro rata over the remaining partners
+    factors = np.ones((len(scenarios), len(reporter_code_list), len(partner_code_list)))
+    reallocate = np.zeros(len(scenarios), dtype=bool)
+
+    for iscenario, scenario in enumerate(scenarios):
+        codes = list(scenario.get("remove", ())) + list(scenario.get("scale", {}))
+        missing = np.setdiff1d(codes, partner_code_list)
+        if len(missing) > 0:
+            raise NameError(f"no such partners {missing} in scenario {iscenario}")
+        missing = np.setdiff1d(scenario.get("reporters", ()), reporter_code_list)
+        if len(missing) > 0:
+            raise NameError(f"no such reporters {missing} in scenario {iscenario}")
+
+        partner_factor = np.ones(len(partner_code_list))
+        for code, factor in scenario.get("scale", {}).items():
+            partner_factor[partner_code_list == code] *= factor
+        partner_factor[np.isin(partner_code_list, scenario.get("remove", ()))] = 0.0
+
+        irep = np.isin(reporter_code_list, scenario.get("reporters", reporter_code_list))
+        factors[iscenario, irep, :] = partner_factor
+        reallocate[iscenario] = scenario.get("reallocate", False)
+
+    return factors, reallocate
+
+
+def evaluate_trade_scenarios(
+    settings,
+    factors,
+    reallocate,
+    data_hotwet=None,
+    data_hotdry=None,
+    batch_size=None,
+    workers=1,
+    rewrite=False,
+    save=True,
+):
+    # total stress [scenario, reporter, sample] and the reporter metrics (indexed by
+    # scenario and reporter) of a batch of trade scenarios, see build_trade_scenarios.
+    # The partner responses come from their cache (or are computed from the climate data
+    # once, see get_partner_response for rewrite and save), and the scenarios are split
+    # into contiguous blocks across workers.
+    (
+        __,
+        reporter_code_list,
+        __,
+        trade_matrix,
+        partner_code_list,
+    ) = get_trade_data(settings, return_matrix=True)
+    partner_response = get_partner_stress(
+        data_hotwet, data_hotdry, partner_code_list, settings, rewrite, save
+    )
+
+    inputs = (
+        trade_matrix,
+        partner_response,
+        settings,
+        reporter_code_list,
+        partner_code_list,
+    )
+    workers = min(workers, len(factors))
+    if workers <= 1:
+        total_stress, df_metrics = compute_trade_scenarios(
+            *inputs, factors, reallocate, 0, batch_size
+        )
+    else:
+        iblock_list = np.array_split(np.arange(len(factors)), workers)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            block_list = list(
+                executor.map(
+                    compute_trade_scenarios,
+                    *zip(*[inputs] * workers),
+                    [factors[iblock] for iblock in iblock_list],
+                    [reallocate[iblock] for iblock in iblock_list],
+                    [iblock[0] if len(iblock) else 0 for iblock in iblock_list],
+                    [batch_size] * workers,
+                )
+            )
+        total_stress = np.concatenate([block[0] for block in block_list])
+        df_metrics = pd.concat([block[1] for block in block_list])
+
+    return reporter_code_list, total_stress, df_metrics
+
+
+def compute_trade_scenarios(
+    trade_matrix,
+    partner_response,
+    settings,
+    reporter_code_list,
+    partner_code_list,
+    factors,
+    reallocate,
+    first_scenario=0,
+    batch_size=None,
+):
+    # evaluates batch_size scenarios at a time as [scenario, reporter, sample, partner]
+    # tensors, weighting the [partner, sample] responses as in
+    # compute_cropstress_trade_percentage. By default the batches are sized to
+    # SCENARIO_BATCH_BYTES.
+    if batch_size is None:
+        tensor_bytes = 8 * trade_matrix.size * partner_response.shape[-1]
+        batch_size = max(1, int(SCENARIO_BATCH_BYTES // tensor_bytes))
+    response = partner_response.T[np.newaxis, np.newaxis, :, :]
+    total_list = []
+    metrics_list = []
+
+    for ibatch in range(0, len(factors), batch_size):
+        scenario_trade = trade_matrix[np.newaxis] * factors[ibatch : ibatch + batch_size]
+        n_scenarios = len(scenario_trade)
+
+        # without reallocation the lost imports are not replaced
+        imports = np.where(
+            reallocate[ibatch : ibatch + batch_size, np.newaxis],
+            np.sum(scenario_trade, axis=-1),
+            np.sum(trade_matrix, axis=-1)[np.newaxis, :],
+        )
+        trade_shares = get_origin_shares(
+            scenario_trade, reporter_code_list, partner_code_list, settings, imports
+        )
+
+        has_stress = (trade_shares[:, :, np.newaxis, :] != 0) & ~np.isnan(response)
+        traded_stress = (
+            np.where(has_stress, response, np.nan) * trade_shares[:, :, np.newaxis, :]
+        )
+        total_list.append(np.nansum(traded_stress, axis=-1))
+
+        # metrics of all scenarios at once, with the scenarios stacked as reporters
+        df_metrics = metrics.compute_reporter_metrics(
+            traded_stress.reshape((-1,) + traded_stress.shape[2:]),
+            scenario_trade.reshape(-1, scenario_trade.shape[-1]),
+            np.tile(reporter_code_list, n_scenarios),
+            partner_code_list,
+        )
+        df_metrics.index = pd.MultiIndex.from_product(
+            (
+                np.arange(n_scenarios) + first_scenario + ibatch,
+                reporter_code_list,
+            ),
+            names=("scenario", "reporter"),
+        )
+        metrics_list.append(df_metrics)
+
+    return np.concatenate(total_list), pd.concat(metrics_list)
 
 
 def get_moore_coefs(product):
@@ -7,17 +7,41 @@ Functions
 
 import numpy as np
 import xarray as xr
+import scipy.sparse as sparse
 import geopandas as gpd
 import regionmask
 import os
 import matplotlib.pyplot as plt
 import pandas as pd
 import datetime
+import hashlib
+import tempfile
+import shutil
+import concurrent.futures
 import file_handling
 
 SEASONS_DIRECTORY = "data/sacks_etal_2010/"
 LONGNAME_FILE = "data/GTAP_data/2023-06-16-LongName.xlsx"
 
+WINDOW_REDUCERS = {
+    "max": lambda x: x.max("step", skipna=True),
+    "mean": lambda x: x.mean("step", skipna=True),
+    "sum": lambda x: x.sum("step", skipna=True),
+    "count": lambda x: (x > 0).sum("step"),
+    "any": lambda x: (x > 0).any("step"),
+}
+
+_GROWING_SEASON_MASKS = {}
+_REGION_NAMES = {}
+_REGIONS = {}
+_COUNTRY_MASKS = {}
+GCM_GRIDS = {}
+# small files already on the grid of each GCM, see get_grid_spec
+GCM_GRID_FILES = {
+    "mpi": "data/cropgrid/processed_crops/wht_mpi_regrid.nc",
+    "cesm2": "data/cropgrid/processed_crops/wht_cesm2_regrid.nc",
+}
+
 
 def quantile_fun(x, perc):
     return x.quantile(perc / 100.0, dim=("member", "time"))
@@ -29,31 +53,54 @@ def get_population(filepath, da_grid):
     da_pop = da_pop.sortby(da_pop.lon)
     print(da_pop.sum(("lat", "lon")))
 
-    # da_pop_regrid = np.zeros((len(da_all["lat"].values), len(da_all["lon"].values)))
-    da_pop_regrid = xr.zeros_like(da_grid[:, :].squeeze())
-
-    for ilat, lat in enumerate(da_grid["lat"].values[:-1]):
-        for ilon, lon in enumerate(da_grid["lon"].values):
-            if ilon == len(da_grid["lon"].values) - 1:
-                eval_lon = 361.0
-            else:
-                eval_lon = da_grid["lon"][ilon + 1]
-            ilat_pop = np.where(
-                (da_pop["lat"] >= da_grid["lat"][ilat])
-                & (da_pop["lat"] < da_grid["lat"][ilat + 1])
-            )[0]
-            ilon_pop = np.where(
-                (da_pop["lon"] >= da_grid["lon"][ilon]) & (da_pop["lon"] < eval_lon)
-            )[0]
-
-            da_pop_regrid[ilat, ilon] = da_pop[ilat_pop, ilon_pop].sum(("lat", "lon"))
-
+    da_pop_regrid = regrid_sum(da_pop, da_grid[:, :].squeeze())
     print(da_pop_regrid.sum(("lat", "lon")))
 
     return da_pop_regrid
 
 
-def compute_extremes_response(settings, data_directory):
+def regrid_sum(da, da_grid):
+    # sum every source gridpoint of da into the target cell of da_grid it falls in. Target
+    # cells span from their own (lat, lon) to the next one, the first and last rows extend
+    # to the poles and the last column wraps around to the first, so the global total is
+    # kept.
+    lat_index = get_bin_index(da_grid["lat"].values, da["lat"].values)
+    lon_index = get_bin_index(
+        da_grid["lon"].values, np.mod(da["lon"].values, 360), wrap=True
+    )
+
+    n_lon = len(da_grid["lon"])
+    cell_index = lat_index[:, np.newaxis] * n_lon + lon_index[np.newaxis, :]
+    regrid = np.bincount(
+        cell_index.ravel(),
+        weights=np.nan_to_num(da.transpose("lat", "lon").values).ravel(),
+        minlength=len(da_grid["lat"]) * n_lon,
+    )
+
+    da_regrid = xr.zeros_like(da_grid, dtype=float)
+    da_regrid.values = regrid.reshape(da_regrid.shape)
+
+    return da_regrid
+
+
+def get_bin_index(edges, x, wrap=False):
+    # index of the bin [edges[i], edges[i + 1]) for every x. Values below the first edge go
+    # into the last bin if wrap (longitudes), and into the first bin otherwise.
+    isort = np.argsort(edges)
+    ibin = np.searchsorted(edges[isort], x, side="right") - 1
+    if not wrap:
+        ibin = np.maximum(ibin, 0)
+    return isort[ibin]
+
+
+def compute_extremes_response(
+    settings, data_directory, tile_size=None, scratch_directory=None
+):
+    if tile_size is not None:
+        return compute_extremes_response_tiled(
+            settings, data_directory, tile_size, scratch_directory
+        )
+
     data_out = None
 
     for var, tail, perc in zip(
@@ -62,94 +109,21 @@ def compute_extremes_response(settings, data_directory):
         print(f"computing extremes for {var}, {tail}, {perc}")
 
         settings.update({"var": var})
-        data = file_handling.load_climate_data(settings, data_directory)
-        da_response = xr.zeros_like(data)
-
-        # define baseline months
-        data_baseline = (
-            data.loc[
-                :,
-                str(settings["baseline_years"][0]) : str(settings["baseline_years"][1]),
-                :,
-                :,
-            ]
-            .groupby("time.month")
-            .mean(("member", "time"))
+        data = file_handling.load_climate_data(
+            settings, data_directory, workers=settings.get("workers", 1)
         )
-
-        # get growing season mask
         if settings["growing_season_only"]:
-            print("    naning out everything not in the growing season.")
-            data_baseline = growing_season_mask(data_baseline, settings)
-
-        # define anomalies based on monthly baselines, nan out non-growing seasons
-        for month in np.arange(1, 13):
-            data[:, data.time.dt.month == month, :, :] = (
-                data[:, data.time.dt.month == month, :, :]
-                - data_baseline[month - 1, :, :]
-            )
-
-        # define extremes based on percentiles
-        # yes, i loop through month again, which is not necessary, but it is more understandable
-        for month in np.arange(1, 13):
-            da_month = data[:, data.time.dt.month == month, :, :]
-            baseline_threshold = np.percentile(
-                da_month.loc[
-                    :,
-                    str(settings["baseline_years"][0]) : str(
-                        settings["baseline_years"][1]
-                    ),
-                    :,
-                    :,
-                ],
-                perc,
-                axis=(0, 1),
-            )
-
-            if tail == "above":
-                da_response[:, data.time.dt.month == month, :, :] = xr.where(
-                    da_month > baseline_threshold, 1.0, 0.0
-                )
-            elif tail == "below":
-                da_response[:, data.time.dt.month == month, :, :] = xr.where(
-                    da_month < baseline_threshold, 1.0, 0.0
-                )
-            elif tail == "below_above":
-                baseline_threshold_above = np.percentile(
-                    da_month.loc[
-                        :,
-                        str(settings["baseline_years"][0]) : str(
-                            settings["baseline_years"][1]
-                        ),
-                        :,
-                        :,
-                    ],
-                    100.0 - perc,
-                    axis=(0, 1),
-                )
-
-                # below calculation
-                da_response[:, data.time.dt.month == month, :, :] = xr.where(
-                    (da_month < baseline_threshold), 10.0, 0.0
-                )
-                # above calculation
-                da_response[:, data.time.dt.month == month, :, :] = xr.where(
-                    (da_month > baseline_threshold_above), 20.0, da_response[:, data.time.dt.month == month, :, :]
-                )
-
-            else:
-                raise NotImplementedError
+            season_mask = get_growing_season_mask(data, settings)
+        else:
+            season_mask = None
+        da_response = classify_extremes(data, settings, tail, perc, season_mask)
 
         if data_out is None:
             data_out = da_response
         else:
             data_out = data_out + da_response
 
-    # print(np.unique(data_out))
-    # FIXME: this code is not general, it is specific to the below_above tail
-    data_out = xr.where((data_out != 11.0) & (data_out != 21.0), 0.0, data_out)
-    data_out = xr.where(data_out == 11, 1.0, data_out)
-    data_out = xr.where(data_out == 21, 2.0, data_out)
+    data_out = recode_extremes(data_out)
 
     # WINDOW THE DATA OVER WINDOW LENGTHS WITHIN THE RESPONSE_YEARS_RANGE and TAKE THE MAX to reduce the window down to one number.
     # data_out = window_data_w_mean(data_out, settings)
@@ -161,6 +135,172 @@ def compute_extremes_response(settings, data_directory):
     return data_out
 
 
+def compute_extremes_response_tiled(
+    settings, data_directory, tile_size, scratch_directory=None
+):
+    # out-of-core version of compute_extremes_response. Every variable is loaded into a
+    # memory-mapped scratch file and the extremes are computed for one (lat, lon) tile at
+    # a time, which is exact since the thresholds are defined separately for every
+    # gridpoint. The windowed result is written tile by tile to scratch_directory.
+    # A temporary scratch_directory is removed again, with the (small) windowed result
+    # read into memory first.
+    remove_scratch = scratch_directory is None
+    if remove_scratch:
+        scratch_directory = tempfile.mkdtemp()
+    if np.isscalar(tile_size):
+        tile_size = (tile_size, tile_size)
+
+    try:
+        data_out = compute_extremes_tiles(
+            settings, data_directory, tile_size, scratch_directory
+        )
+        if remove_scratch:
+            data_out = data_out.copy(data=np.array(data_out.values))
+    finally:
+        for var in settings["var_list"]:
+            scratch_file = os.path.join(scratch_directory, var + ".npy")
+            if os.path.exists(scratch_file):
+                os.remove(scratch_file)
+        if remove_scratch:
+            shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    print(data_out.shape)
+
+    return data_out
+
+
+def compute_extremes_tiles(settings, data_directory, tile_size, scratch_directory):
+    # extremes of every (lat, lon) tile, written to a memory-mapped response.npy in
+    # scratch_directory
+    data_list = []
+    for var in settings["var_list"]:
+        settings.update({"var": var})
+        data_list.append(
+            file_handling.load_climate_data(
+                settings,
+                data_directory,
+                scratch_file=os.path.join(scratch_directory, var + ".npy"),
+                workers=settings.get("workers", 1),
+            )
+        )
+    if settings["growing_season_only"]:
+        season_mask = get_growing_season_mask(data_list[0], settings)
+
+    n_lat, n_lon = len(data_list[0]["lat"]), len(data_list[0]["lon"])
+    data_out = None
+    for ilat in range(0, n_lat, tile_size[0]):
+        for ilon in range(0, n_lon, tile_size[1]):
+            tile = {
+                "lat": slice(ilat, ilat + tile_size[0]),
+                "lon": slice(ilon, ilon + tile_size[1]),
+            }
+            print(f"computing extremes for lat {tile['lat']}, lon {tile['lon']}")
+
+            da_tile = None
+            for data, var, tail, perc in zip(
+                data_list,
+                settings["var_list"],
+                settings["response_tail"],
+                settings["response_threshold"],
+            ):
+                print(f"    {var}, {tail}, {perc}")
+                da_response = classify_extremes(
+                    data.isel(tile).copy(),
+                    settings,
+                    tail,
+                    perc,
+                    season_mask.isel(tile) if settings["growing_season_only"] else None,
+                )
+                if da_tile is None:
+                    da_tile = da_response
+                else:
+                    da_tile = da_tile + da_response
+
+            da_tile = window_data_w_max(recode_extremes(da_tile), settings)
+
+            if data_out is None:
+                values = np.lib.format.open_memmap(
+                    os.path.join(scratch_directory, "response.npy"),
+                    mode="w+",
+                    dtype=da_tile.dtype,
+                    shape=da_tile.shape[:2] + (n_lat, n_lon),
+                )
+                coords = {
+                    dim: da_tile[dim] for dim in da_tile.dims[:2] if dim in da_tile.coords
+                }
+                coords.update(lat=data_list[0]["lat"], lon=data_list[0]["lon"])
+                data_out = xr.DataArray(values, dims=da_tile.dims, coords=coords)
+            data_out.values[:, :, tile["lat"], tile["lon"]] = da_tile.values
+
+    return data_out
+
+
+def classify_extremes(data, settings, tail, perc, season_mask=None):
+    # compact int8 category codes of one variable (1 for the "above" and "below" tails,
+    # 10 below and 20 above for the "below_above" tail). Anomalies are computed in place
+    # in data, one month block at a time.
+    values = data.values
+    months = data["time.month"].values
+    years = data["time.year"].values
+    in_baseline = (years >= settings["baseline_years"][0]) & (
+        years <= settings["baseline_years"][1]
+    )
+    codes = np.zeros(values.shape, dtype=np.int8)
+
+    if season_mask is not None:
+        print("    naning out everything not in the growing season.")
+
+    for month in np.arange(1, 13):
+        itime = month_block(months == month)
+        da_month = values[:, itime]
+
+        # define anomalies based on monthly baselines, nan out non-growing seasons
+        data_baseline = np.nanmean(da_month[:, in_baseline[itime]], axis=(0, 1))
+        if season_mask is not None:
+            data_baseline[~season_mask.values[month - 1]] = np.nan
+        da_month -= data_baseline
+
+        # define extremes based on percentiles
+        da_baseline = da_month[:, in_baseline[itime]]
+        baseline_threshold = np.percentile(da_baseline, perc, axis=(0, 1))
+        if tail == "above":
+            codes[:, itime] = da_month > baseline_threshold
+        elif tail == "below":
+            codes[:, itime] = da_month < baseline_threshold
+        elif tail == "below_above":
+            baseline_threshold_above = np.percentile(
+                da_baseline, 100.0 - perc, axis=(0, 1)
+            )
+            codes[:, itime] = np.where(
+                da_month > baseline_threshold_above,
+                np.int8(20),
+                np.int8(10) * (da_month < baseline_threshold),
+            )
+        else:
+            raise NotImplementedError
+
+    return data.copy(data=codes)
+
+
+def month_block(is_month):
+    # a view (slice) for regularly spaced months, an index array otherwise
+    itime = np.where(is_month)[0]
+    step = itime[1] - itime[0] if len(itime) > 1 else 1
+    if np.all(np.diff(itime) == step):
+        return slice(itime[0], itime[-1] + 1, step)
+    return itime
+
+
+def recode_extremes(data_out):
+    # FIXME: this code is not general, it is specific to the below_above tail
+    # 11 -> 1 (hot-dry), 21 -> 2 (hot-wet), everything else -> 0
+    recode = np.zeros(128, dtype=np.int8)
+    recode[11] = 1
+    recode[21] = 2
+
+    return data_out.copy(data=recode[data_out.values])
+
+
 def compute_reanalysis_baseline(settings, data_directory, data_like):
     assert len(settings["var_list"]) == 1, "not implemented yet."
     var = settings["var_list"][0]
@@ -192,7 +332,9 @@ def compute_anomalies(settings, data_directory):
 
     print("loading the data")
     settings.update({"var": var})
-    data = file_handling.load_climate_data(settings, data_directory)
+    data = file_handling.load_climate_data(
+        settings, data_directory, workers=settings.get("workers", 1)
+    )
 
     # define baseline months
     data_baseline = (
@@ -222,6 +364,38 @@ def compute_anomalies(settings, data_directory):
 
 
 def growing_season_mask(data, settings):
+    # nan out the baseline for not the growing season
+    return data.where(get_growing_season_mask(data, settings))
+
+
+def get_growing_season_mask(data, settings):
+    # (month x lat x lon) mask of the growing season months on the grid of data,
+    # cached on disk (and in memory) for each product and grid
+    lat = data["lat"].values
+    lon = data["lon"].values
+    grid_hash = hashlib.sha1(
+        np.concatenate((lat, lon)).astype(float).tobytes()
+    ).hexdigest()[:8]
+    filename = (
+        SEASONS_DIRECTORY
+        + "growing_season_mask_"
+        + settings["product"]
+        + f"_{len(lat)}x{len(lon)}_{grid_hash}.nc"
+    )
+
+    if filename not in _GROWING_SEASON_MASKS:
+        if os.path.exists(filename):
+            print("    loading growing season mask from " + filename)
+            mask = xr.load_dataarray(filename).astype(bool)
+        else:
+            mask = build_growing_season_mask(lat, lon, settings)
+            mask.astype(np.int8).to_netcdf(filename)
+        _GROWING_SEASON_MASKS[filename] = mask
+
+    return _GROWING_SEASON_MASKS[filename]
+
+
+def build_growing_season_mask(lat, lon, settings):
     # define growing enddates
     # grow_start, grow_stop = "plant.end", "harvest.start"
     grow_start, grow_stop = "plant", "harvest"
@@ -230,45 +404,66 @@ def growing_season_mask(data, settings):
     # get growing seasons
     da_grow, da_grow2 = get_growing_seasons_data(settings)
 
-    # get the growing season months only
-    all_months = np.arange(1, 13)
-
     # check longitudes and convert if necessary for the growing season data
-    if np.min(data["lon"] >= 0):
-        data_lon = (data["lon"].values + 180) % 360 - 180
+    if np.min(lon >= 0):
+        data_lon = (lon + 180) % 360 - 180
     else:
-        data_lon = data["lon"].values
+        data_lon = lon
 
-    # loop through all gridpoints
-    for ilat in range(len(data["lat"])):
-        ilat_grab = np.argmin(
-            np.abs(data["lat"][ilat].values - da_grow["latitude"].values)
-        )
+    # nearest growing season gridpoint for every data gridpoint
+    ilat_grab = np.argmin(
+        np.abs(lat[:, np.newaxis] - da_grow["latitude"].values[np.newaxis, :]), axis=1
+    )
+    ilon_grab = np.argmin(
+        np.abs(data_lon[:, np.newaxis] - da_grow["longitude"].values[np.newaxis, :]),
+        axis=1,
+    )
+    igrab = np.ix_(ilat_grab, ilon_grab)
 
-        for ilon in range(len(data_lon)):
-            ilon_grab = np.argmin(np.abs(data_lon[ilon] - da_grow["longitude"].values))
+    # get the growing season months only
+    month_mask = get_growing_months(
+        da_grow[grow_start].values[igrab], da_grow[grow_stop].values[igrab]
+    )
 
-            # # get the growing season start and end for each gridpoint
-            month_list = get_growing_month_list(
-                da_grow[grow_start][ilat_grab, ilon_grab].values,
-                da_grow[grow_stop][ilat_grab, ilon_grab].values,
-            )
+    # check if there is a second growing season, if so, add its months to the first season
+    if da_grow2 is not None:
+        month_mask = month_mask | get_growing_months(
+            da_grow2[grow_start].values[igrab], da_grow2[grow_stop].values[igrab]
+        )
 
-            # check if there is a second growing season, if so, append months to the first season
-            if da_grow2 is not None:
-                month_list_second = get_growing_month_list(
-                    da_grow2[grow_start][ilat_grab, ilon_grab].values,
-                    da_grow2[grow_stop][ilat_grab, ilon_grab].values,
-                )
-                month_list = np.unique(
-                    np.append(month_list, month_list_second, axis=0).astype(int)
-                )
+    return xr.DataArray(
+        month_mask,
+        dims=("month", "lat", "lon"),
+        coords={"month": np.arange(1, 13), "lat": lat, "lon": lon},
+    )
 
-            # nan out the baseline for not the growing season
-            month_mask = np.isin(all_months, month_list, assume_unique=True)
-            data[~month_mask, ilat, ilon] = np.nan
 
-    return data
+def get_growing_months(start_doy, end_doy):
+    # vectorized get_growing_month_list, returns a (month x ...) mask
+    valid = np.isfinite(start_doy) & np.isfinite(end_doy)
+    start_doy = np.floor(np.where(valid, start_doy, 1)).astype(int)
+    end_doy = np.ceil(np.where(valid, end_doy, 1)).astype(int)
+
+    # lookup table from day of year to month
+    first_doy = min(np.min(start_doy), np.min(end_doy))
+    last_doy = max(np.max(start_doy), np.max(end_doy))
+    dates = np.datetime64("2030-01-01") + np.arange(
+        first_doy - 1, last_doy
+    ).astype("timedelta64[D]")
+    doy_to_month = dates.astype("datetime64[M]").astype(int) % 12 + 1
+
+    start_month = doy_to_month[start_doy - first_doy]
+    end_month = doy_to_month[end_doy - first_doy]
+
+    # seasons wrap into the next year when they end before they start
+    months = np.arange(1, 13).reshape((12,) + (1,) * np.ndim(start_month))
+    month_mask = np.where(
+        start_month <= end_month,
+        (months >= start_month) & (months <= end_month),
+        (months >= start_month) | (months <= end_month),
+    )
+
+    return month_mask & valid
 
 
 def get_growing_month_list(start_doy, end_doy):
@@ -308,57 +503,17 @@ def get_growing_month_list(start_doy, end_doy):
 
 
 def window_data_w_mean(data, settings):
-    data = data.loc[
-        {
-            data.dims[1]: slice(
-                str(settings["response_year_range"][0]),
-                str(settings["response_year_range"][1]),
-            )
-        }
-    ]
+    return window_data(data, settings, reducer="mean")
 
-    d = None
-    response_years = np.unique(data["time.year"])
-    for year in np.arange(
-        response_years[0], response_years[-1] + 1, settings["window_len"]
-    ):
-        if (year + settings["window_len"]) - 1 > response_years[-1]:
-            break
-
-        if d is None:
-            d = (
-                data.loc[
-                    {
-                        data.dims[1]: slice(
-                            str(year), str((year + settings["window_len"]) - 1)
-                        )
-                    }
-                ]
-                .mean(axis=1, skipna=True)
-                .expand_dims({"window": np.arange(year, year + 1)})
-            )
 
-        else:
-            d = xr.concat(
-                [
-                    d,
-                    data.loc[
-                        {
-                            data.dims[1]: slice(
-                                str(year), str((year + settings["window_len"]) - 1)
-                            )
-                        }
-                    ]
-                    .mean(axis=1, skipna=True)
-                    .expand_dims({"window": np.arange(year, year + 1)}),
-                ],
-                dim="window",
-            )
-
-    return d.transpose("member", "window", "lat", "lon")
+def window_data_w_max(data, settings):
+    return window_data(data, settings, reducer="max")
 
 
-def window_data_w_max(data, settings):
+def window_data(data, settings, reducer="max"):
+    # reduce the time steps within each window_len-year window of the response_year_range
+    # down to one number. reducer is one of WINDOW_REDUCERS or a function that reduces
+    # a DataArray over its "step" dimension.
     data = data.loc[
         {
             data.dims[1]: slice(
@@ -368,48 +523,41 @@ def window_data_w_max(data, settings):
         }
     ]
 
-    d = None
-    response_years = np.unique(data["time.year"])
-    for year in np.arange(
-        response_years[0], response_years[-1] + 1, settings["window_len"]
-    ):
-        if (year + settings["window_len"]) - 1 > response_years[-1]:
-            break
-
-        if d is None:
-            d = (
-                data.loc[
-                    {
-                        data.dims[1]: slice(
-                            str(year), str((year + settings["window_len"]) - 1)
-                        )
-                    }
-                ]
-                .max(axis=1, skipna=True)
-                .expand_dims({"window": np.arange(year, year + 1)})
-            )
+    # only keep complete windows
+    years = data["time.year"].values
+    n_windows = (years[-1] - years[0] + 1) // settings["window_len"]
+    window_years = years[0] + settings["window_len"] * np.arange(n_windows)
+    data = data[:, years < years[0] + n_windows * settings["window_len"]]
+
+    # reshape time into (window, time steps per window)
+    n_steps = data.shape[1] // n_windows
+    assert n_steps * n_windows == data.shape[1], "windows have different lengths"
+    dims = (data.dims[0], "window", "step") + data.dims[2:]
+    d = xr.DataArray(
+        data.values.reshape(data.shape[:1] + (n_windows, n_steps) + data.shape[2:]),
+        dims=dims,
+        coords={dim: data[dim] for dim in dims if dim in data.coords}
+        | {"window": window_years},
+    )
 
-        else:
-            d = xr.concat(
-                [
-                    d,
-                    data.loc[
-                        {
-                            data.dims[1]: slice(
-                                str(year), str((year + settings["window_len"]) - 1)
-                            )
-                        }
-                    ]
-                    .max(axis=1, skipna=True)
-                    .expand_dims({"window": np.arange(year, year + 1)}),
-                ],
-                dim="window",
-            )
+    if not callable(reducer):
+        reducer = WINDOW_REDUCERS[reducer]
+    d = reducer(d)
 
     return d.transpose("member", "window", "lat", "lon")
 
 
 def get_growing_seasons_data(settings):
+    file, file2 = get_growing_seasons_filenames(settings)
+
+    if file2 is None:
+        return xr.load_dataset(file), None
+    else:
+        print("    loading two growing seasons")
+        return xr.load_dataset(file), xr.load_dataset(file2)
+
+
+def get_growing_seasons_filenames(settings):
     if settings["product"] == "pdr":
         file = SEASONS_DIRECTORY + "Rice.crop.calendar.fill.nc"
         file2 = SEASONS_DIRECTORY + "Rice.2.crop.calendar.fill.nc"
@@ -429,16 +577,17 @@ def get_growing_seasons_data(settings):
     else:
         raise NotImplementedError("no such file.")
 
-    if file2 is None:
-        return xr.load_dataset(file), None
-    else:
-        print("    loading two growing seasons")
-        return xr.load_dataset(file), xr.load_dataset(file2)
+    return file, file2
 
 
 def build_response_data(settings, data_directory):
     if settings["response_type"] == "extremes":
-        data = compute_extremes_response(settings, data_directory)
+        data = compute_extremes_response(
+            settings,
+            data_directory,
+            tile_size=settings.get("tile_size"),
+            scratch_directory=settings.get("scratch_directory"),
+        )
 
     elif settings["response_type"] == "anomalies":
         data, data_baseline = compute_anomalies(settings, data_directory)
@@ -469,58 +618,159 @@ def process_member(settings, da):
 
 
 def get_cropped_area_mask(CROP_DIRECTORY, settings, include_irrigated=True):
+    filename = get_cropped_area_filename(CROP_DIRECTORY, settings, include_irrigated)
+    print("loading crop areas from " + filename)
+    return xr.load_dataarray(filename)
 
+
+def get_cropped_area_filename(CROP_DIRECTORY, settings, include_irrigated=True):
     if include_irrigated:
-        filename = (
+        return (
             CROP_DIRECTORY + settings["product"] + "_" + settings["gcm"] + "_regrid.nc"
         )
-        print("loading crop areas from " + filename)
-        return xr.load_dataarray(filename)
     else:
-        filename = (
+        return (
             CROP_DIRECTORY
             + settings["product"]
             + "_unirrigated_"
             + settings["gcm"]
             + "_regrid.nc"
         )
-        print("loading crop areas from " + filename)
-        return xr.load_dataarray(filename)
 
 
 def get_country_masks(settings, SHAPE_DIRECTORY, DATA_DIRECTORY):
 
     country_loadfile = SHAPE_DIRECTORY + "countries_10m_" + settings["gcm"] + ".nc"
-    regs_shp = gpd.read_file(SHAPE_DIRECTORY + "20230301_gtapv11.shp")
-    regs_shp = (
-        regs_shp.dissolve(by="REG", as_index=False)
-        .sort_values(by="GTAPID")
-        .reset_index(drop=True)
-    )
+    regs_shp = get_regions(SHAPE_DIRECTORY)
 
-    if os.path.exists(country_loadfile):
+    if country_loadfile in _COUNTRY_MASKS:
+        mask_country = _COUNTRY_MASKS[country_loadfile]
+    elif os.path.exists(country_loadfile):
         print("loading " + country_loadfile)
         mask_country = xr.load_dataarray(
             SHAPE_DIRECTORY + "countries_10m_" + settings["gcm"] + ".nc"
         )
     else:
-        pass_settings = {
-            "gcm": settings["gcm"],
-            "var": "tas",
-            "n_members": 1,
-            "data_years": (2020, 2040),
-            "avg_frequency": "month",
-        }
-
-        da_all = file_handling.load_climate_data(pass_settings, DATA_DIRECTORY)
-        mask_country = regionmask.mask_geopandas(regs_shp, da_all.lon, da_all.lat)
-        mask_country.to_netcdf(
-            SHAPE_DIRECTORY + "countries_10m_" + settings["gcm"] + ".nc"
-        )
+        grids = {settings["gcm"]: get_grid_spec(settings["gcm"], DATA_DIRECTORY)}
+        mask_country = build_country_masks(regs_shp, grids, SHAPE_DIRECTORY)[
+            settings["gcm"]
+        ]
+    _COUNTRY_MASKS[country_loadfile] = mask_country
 
     return mask_country, regs_shp
 
 
+def get_region_caches():
+    # the country masks and regions loaded in this process, to hand to worker processes
+    return _COUNTRY_MASKS, _REGIONS
+
+
+def set_region_caches(country_masks, regions):
+    _COUNTRY_MASKS.update(country_masks)
+    _REGIONS.update(regions)
+
+
+def get_grid_spec(gcm, DATA_DIRECTORY):
+    # (lat, lon) of a GCM grid, from GCM_GRIDS, from the crop area file of GCM_GRID_FILES
+    # on the same grid, or else from the coordinates of the first ensemble member file if
+    # the big-data archive is present (without reading the data itself)
+    if gcm not in GCM_GRIDS:
+        filename = GCM_GRID_FILES.get(gcm)
+        if filename is None or not os.path.exists(filename):
+            pass_settings = {"gcm": gcm, "var": "tas", "n_members": 1}
+            try:
+                member_filenames = file_handling.get_member_filenames(
+                    pass_settings, DATA_DIRECTORY
+                )
+            except NotImplementedError:
+                member_filenames = []
+            if len(member_filenames) == 0 or not os.path.exists(member_filenames[0][0]):
+                raise ValueError(
+                    f"unknown grid for gcm {gcm}: no {filename} and no member files in "
+                    f"{DATA_DIRECTORY}, register it with register_grid"
+                )
+            filename = member_filenames[0][0]
+        with xr.open_dataset(filename) as ds:
+            register_grid(gcm, ds["lat"].values, ds["lon"].values)
+
+    return GCM_GRIDS[gcm]
+
+
+def register_grid(gcm, lat, lon):
+    GCM_GRIDS[gcm] = (np.asarray(lat), np.asarray(lon))
+
+
+def build_country_masks(regs_shp, grids, SHAPE_DIRECTORY, workers=1):
+    # rasterize all regions onto several {gcm: (lat, lon)} grids, in parallel over grids
+    gcm_list = list(grids)
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            mask_list = list(
+                executor.map(
+                    rasterize_regions,
+                    [regs_shp] * len(gcm_list),
+                    [grids[gcm] for gcm in gcm_list],
+                )
+            )
+    else:
+        mask_list = [rasterize_regions(regs_shp, grids[gcm]) for gcm in gcm_list]
+
+    for gcm, mask_country in zip(gcm_list, mask_list):
+        mask_country.to_netcdf(SHAPE_DIRECTORY + "countries_10m_" + gcm + ".nc")
+
+    return dict(zip(gcm_list, mask_list))
+
+
+def rasterize_regions(regs_shp, grid):
+    lat, lon = grid
+    return regionmask.mask_geopandas(regs_shp, lon, lat)
+
+
+def get_regions(SHAPE_DIRECTORY):
+    # GTAP regions dissolved from the GADM shapefile and sorted by GTAPID. Dissolving
+    # takes minutes, so the result is cached in memory and as a pickle next to the
+    # shapefile, keyed on the size and modification time of the shapefile itself.
+    shapefile = SHAPE_DIRECTORY + "20230301_gtapv11"
+    input_stats = file_handling.get_input_stats(
+        [shapefile + ext for ext in (".shp", ".shx", ".dbf")]
+    )
+    key = file_handling.settings_fingerprint(input_stats, input_stats)
+    regions_loadfile = shapefile + "_dissolved_" + key + ".pickle"
+
+    if regions_loadfile not in _REGIONS:
+        if os.path.exists(regions_loadfile):
+            print("loading " + regions_loadfile)
+            regs_shp = pd.read_pickle(regions_loadfile)
+        else:
+            regs_shp = gpd.read_file(shapefile + ".shp")
+            regs_shp = (
+                regs_shp.dissolve(by="REG", as_index=False)
+                .sort_values(by="GTAPID")
+                .reset_index(drop=True)
+            )
+            regs_shp.to_pickle(regions_loadfile)
+        get_region_lookup(regs_shp)
+        _REGIONS[regions_loadfile] = regs_shp
+
+    return _REGIONS[regions_loadfile]
+
+
+def get_region_lookup(regs_shp, centroids=False):
+    # REG -> shapefile index (and REG -> centroid) dictionaries, stored with regs_shp.
+    # pandas copies attrs onto filtered or reordered frames, so a stored lookup is only
+    # used if it was built from the same rows.
+    rows = (regs_shp["REG"].tolist(), regs_shp.index.tolist())
+    lookup = regs_shp.attrs.get("reg_lookup", {})
+    if lookup.get("rows") != rows:
+        lookup = {"rows": rows, "index": dict(zip(*rows))}
+        regs_shp.attrs["reg_lookup"] = lookup
+    if centroids and "centroid" not in lookup:
+        centroid = regs_shp.centroid
+        lookup["centroid"] = dict(zip(regs_shp["REG"], zip(centroid.x, centroid.y)))
+
+    return lookup
+
+
 def get_ocean_mask(mask_country):
     return xr.where(np.isnan(mask_country), 1.0, np.nan)
 
@@ -547,13 +797,108 @@ def compute_global_sum(da):
     return global_sum
 
 
-def get_name_from_code(codes):
-    da = pd.read_excel(LONGNAME_FILE, "regions")
+def get_region_crop_weights(
+    region_code_list, regs_shp, mask_country, da_crop_area, da_crop_unirr_area
+):
+    # sparse (region x gridcell) matrices of cos(lat) x cropped area, normalized by the
+    # (irrigated + unirrigated) cropped area of each region. Multiplying a flattened map
+    # by these gives the same regional sums as compute_global_sum over the masked crop area.
+    mask_country, da_crop_area, da_crop_unirr_area = xr.align(
+        mask_country.transpose("lat", "lon"),
+        da_crop_area.transpose("lat", "lon"),
+        da_crop_unirr_area.transpose("lat", "lon"),
+        join="exact",
+    )
+    n_lon = len(mask_country["lon"])
+    labels = mask_country.values.ravel()
+
+    weights = np.cos(np.deg2rad(mask_country["lat"].values))
+    weights = np.repeat(weights, n_lon)
+    area = weights * np.nan_to_num(da_crop_area.values.ravel())
+    area_unirr = weights * np.nan_to_num(da_crop_unirr_area.values.ravel())
+
+    # gridcells for each region, falling back to the closest gridpoint for small islands
+    rows, cols = [], []
+    for ireg, code in enumerate(region_code_list):
+        ishp = map_to_shapefile(regs_shp, code)
+        icells = np.where(labels == ishp)[0]
+        if len(icells) == 0:
+            ilat, ilon = get_closest_gridpoint(regs_shp, code, mask_country)
+            icells = np.array([ilat * n_lon + ilon])
+        rows.append(np.full(len(icells), ireg))
+        cols.append(icells)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    shape = (len(region_code_list), len(labels))
+
+    weights_irr = sparse.csr_matrix((area[cols], (rows, cols)), shape=shape)
+    weights_unirr = sparse.csr_matrix((area_unirr[cols], (rows, cols)), shape=shape)
+
+    # regions without cropped area sum to zero, as with compute_global_sum
+    denominator = np.asarray(weights_irr.sum(axis=1)).ravel()
+    inv_denominator = np.divide(
+        1.0, denominator, out=np.zeros_like(denominator), where=denominator > 0
+    )
+    normalize = sparse.diags(inv_denominator)
+
+    return (normalize @ weights_irr).tocsr(), (normalize @ weights_unirr).tocsr()
+
+
+def compute_region_sums(weights, da, chunk_size=256):
+    # returns (region x sample) sums of da over the gridcells in each row of weights.
+    # Compact (e.g. int8) data is converted to float chunk_size samples at a time.
+    x = da.transpose(..., "lat", "lon").values
+    x = x.reshape(-1, x.shape[-2] * x.shape[-1])
+    assert x.shape[-1] == weights.shape[-1], "data and weights are on different grids"
+
+    region_sums = np.zeros((weights.shape[0], x.shape[0]))
+    for i in range(0, x.shape[0], chunk_size):
+        region_sums[:, i : i + chunk_size] = weights @ x[i : i + chunk_size].T.astype(
+            float, copy=False
+        )
+
+    return region_sums
 
-    names = []
-    for code_val in codes:
-        i = np.where(da["GTAP Region Code"] == code_val)[0]
-        names.append(da["Long Name"][i].values[0])
+
+def get_region_names():
+    # GTAP region codes and long names, read from the xlsx once and then from a
+    # binary sidecar next to it (rebuilt whenever the xlsx is newer)
+    if not _REGION_NAMES:
+        sidecar = os.path.splitext(LONGNAME_FILE)[0] + ".npz"
+        if os.path.exists(sidecar) and (
+            not os.path.exists(LONGNAME_FILE)
+            or os.path.getmtime(sidecar) >= os.path.getmtime(LONGNAME_FILE)
+        ):
+            with np.load(sidecar) as f:
+                codes, names = f["codes"], f["names"]
+        else:
+            da = pd.read_excel(LONGNAME_FILE, "regions")
+            codes = da["GTAP Region Code"].values.astype(str)
+            names = da["Long Name"].values.astype(str)
+            np.savez(sidecar, codes=codes, names=names)
+
+        for key, values, other in (("code", codes, names), ("name", names, codes)):
+            isort = np.argsort(values, kind="stable")
+            _REGION_NAMES[key] = (values[isort], other[isort])
+
+    return _REGION_NAMES
+
+
+def lookup_region_names(values, key="code"):
+    # vectorized code -> name (key="code") or name -> code (key="name") lookup
+    sorted_values, other = get_region_names()[key]
+    values = np.asarray(values, dtype=str)
+
+    i = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    missing = sorted_values[i] != values
+    if np.any(missing):
+        raise ValueError("no such region " + key + ": " + str(values[missing]))
+
+    return other[i]
+
+
+def get_name_from_code(codes):
+    names = lookup_region_names(codes, key="code").tolist()
 
     if len(names) == 1:
         return names[0]
@@ -561,8 +906,17 @@ def get_name_from_code(codes):
         return names
 
 
+def get_code_from_name(names):
+    codes = lookup_region_names(names, key="name").tolist()
+
+    if len(codes) == 1:
+        return codes[0]
+    else:
+        return codes
+
+
 def map_to_shapefile(regs_shp, code):
-    ishp = regs_shp[regs_shp["REG"] == code].index.to_numpy()[0]
+    ishp = get_region_lookup(regs_shp)["index"].get(code)
 
     if ishp is None:
         raise NameError
@@ -577,11 +931,9 @@ def convert_lons(x):
 
 
 def get_closest_gridpoint(regs_shp, code, mask_country):
-    country_centroid = regs_shp[regs_shp["REG"] == code].centroid
-    ilat = np.argmin(np.abs(mask_country["lat"] - country_centroid.y.values[0]).values)
-    ilon = np.argmin(
-        np.abs(mask_country["lon"] - convert_lons(country_centroid.x.values[0])).values
-    )
+    centroid_x, centroid_y = get_region_lookup(regs_shp, centroids=True)["centroid"][code]
+    ilat = np.argmin(np.abs(mask_country["lat"].values - centroid_y))
+    ilon = np.argmin(np.abs(mask_country["lon"].values - convert_lons(centroid_x)))
 
     return ilat, ilon
 
@@ -595,3 +947,35 @@ def create_country_mask(country_code, regs_shp, mask_country):
         mask_reporter[ilat, ilon] = 1.0
 
     return mask_reporter
+
+
+def paint_regions(region_code_list, values, regs_shp, mask_country):
+    # map a value per region (R,) or per region and sample (R, S) onto the grid in one
+    # gather over the mask_country labels. Cells outside the regions are 0, and regions
+    # without cells are added at their closest gridpoint, as with create_country_mask.
+    values = np.asarray(values, dtype=float)
+    ishp = np.array([map_to_shapefile(regs_shp, code) for code in region_code_list], dtype=int)
+
+    labels = mask_country.values
+    is_region = ~np.isnan(labels)
+    labels = np.where(is_region, labels, -1).astype(int)
+
+    row_lookup = np.full(max(labels.max(), ishp.max()) + 2, -1)
+    row_lookup[ishp] = np.arange(len(ishp))
+    rows = row_lookup[labels]
+    has_row = rows >= 0
+
+    # move the region axis last so it can be gathered for every gridpoint at once
+    padded = np.concatenate((np.moveaxis(values, 0, -1), np.zeros(values.shape[1:] + (1,))), axis=-1)
+    painted = padded[..., np.where(has_row, rows, -1)]
+
+    missing = np.setdiff1d(np.arange(len(ishp)), np.unique(rows[has_row]))
+    for irow in missing:
+        ilat, ilon = get_closest_gridpoint(regs_shp, region_code_list[irow], mask_country)
+        painted[..., ilat, ilon] += values[irow]
+
+    if values.ndim == 1:
+        return xr.DataArray(painted, coords=mask_country.coords, dims=mask_country.dims)
+    return xr.DataArray(
+        painted, coords=mask_country.coords, dims=("sample",) + mask_country.dims
+    )
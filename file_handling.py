@@ -8,13 +8,25 @@ Functions
 import numpy as np
 import pandas as pd
 import xarray as xr
-import gzip
-import pickle
 import os
+import json
+import shutil
+import hashlib
+import time
+import collections
+import contextlib
+import concurrent.futures
 import data_processing
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 DATA_DIRECTORY = "/Users/eabarnes/big_data/"
 PROCESSED_DIRECTORY = "processed_data/"
+CACHE_MANIFEST = "cache_manifest.json"
+CACHE_BUDGET_BYTES = 200 * 1024**3
 
 
 def convert_longitudes(da):
@@ -29,16 +41,178 @@ def convert_longitudes(da):
     return da
 
 
-def load_metrics(filename):
-    with gzip.open(filename, "rb") as fp:
-        reporter_code_list = pickle.load(fp)
-        traded_stress = pickle.load(fp)
-        unweighted_stress = pickle.load(fp)
-        df_stress = pickle.load(fp)
-        df_metrics = pickle.load(fp)
+def settings_fingerprint(settings, keys, inputs=()):
+    # canonical hash of the settings that affect a stage, and of the names of its inputs
+    # (file names or the fingerprints of upstream caches). It does not depend on the
+    # files themselves, so the same settings give the same key on every machine.
+    fingerprint = {
+        "settings": {key: settings.get(key) for key in sorted(keys)},
+        "inputs": list(inputs),
+    }
+    fingerprint = json.dumps(fingerprint, sort_keys=True, default=str)
+
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+
+
+def get_cache_filename(directory, settings, keys, suffix, inputs=()):
+    # content-addressed, so experiments with the same settings and inputs share a cache
+    return directory + settings_fingerprint(settings, keys, inputs) + suffix
+
+
+def get_input_stats(input_files):
+    # [size, modification time] of the input files that are present
+    return {
+        filename: [os.path.getsize(filename), os.path.getmtime(filename)]
+        for filename in input_files
+        if os.path.exists(filename)
+    }
+
+
+def is_cache_current(filename):
+    # whether a cached file exists and none of the input files recorded with it in the
+    # manifest has changed since. Inputs that are not present, e.g. the raw climate data
+    # away from the archive, are not checked.
+    if not os.path.exists(filename):
+        return False
+    directory, name = os.path.split(filename)
+    recorded = load_cache_manifest(directory).get(name, {}).get("inputs", {})
+    current = get_input_stats(recorded)
+
+    return all(current[input_file] == recorded[input_file] for input_file in current)
+
+
+def get_cache_size(filename):
+    if os.path.isdir(filename):
+        return sum(
+            os.path.getsize(os.path.join(root, file))
+            for root, __, files in os.walk(filename)
+            for file in files
+        )
+    return os.path.getsize(filename)
+
+
+def load_cache_manifest(directory):
+    manifest_filename = os.path.join(directory, CACHE_MANIFEST)
+    if not os.path.exists(manifest_filename):
+        return {}
+    with open(manifest_filename) as fp:
+        return json.load(fp)
+
+
+def save_cache_manifest(directory, manifest):
+    # written to a temporary file first, so loading never sees a partial manifest
+    manifest_filename = os.path.join(directory, CACHE_MANIFEST)
+    tmp_filename = manifest_filename + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_filename, "w") as fp:
+        json.dump(manifest, fp, indent=1)
+    os.replace(tmp_filename, manifest_filename)
+
+
+@contextlib.contextmanager
+def lock_cache_manifest(directory):
+    # exclusive lock around a read-modify-write of the manifest, since subexperiments
+    # update it from several processes. Without fcntl (Windows) this does not lock.
+    with open(os.path.join(directory, CACHE_MANIFEST + ".lock"), "a") as fp:
+        if fcntl is not None:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+        yield
+
+
+def touch_cache(filename):
+    # mark a cached file as recently used
+    directory, name = os.path.split(filename)
+    with lock_cache_manifest(directory):
+        manifest = load_cache_manifest(directory)
+        if name in manifest:
+            manifest[name]["last_access"] = time.time()
+            save_cache_manifest(directory, manifest)
+
+
+def register_cache(filename, settings, max_bytes=CACHE_BUDGET_BYTES, input_files=()):
+    # add a newly saved file, with the stats of the input files it was computed from, to
+    # the manifest, then evict the least recently used files until the directory fits
+    # within max_bytes. A max_bytes of None leaves the pruning to the caller (see
+    # cropstress.run_subexperiments).
+    directory, name = os.path.split(filename)
+    with lock_cache_manifest(directory):
+        manifest = load_cache_manifest(directory)
+        manifest[name] = {
+            "exp_name": settings["exp_name"],
+            "size": get_cache_size(filename),
+            "created": time.time(),
+            "last_access": time.time(),
+            "inputs": get_input_stats(input_files),
+        }
+        save_cache_manifest(directory, manifest)
+
+    if max_bytes is not None:
+        prune_cache(directory, max_bytes, keep=(name,))
+
+
+def list_cache(directory):
+    manifest = load_cache_manifest(directory)
+    df = pd.DataFrame.from_dict(
+        manifest,
+        orient="index",
+        columns=["exp_name", "size", "created", "last_access"],
+    )
+    for column in ("created", "last_access"):
+        df[column] = pd.to_datetime(df[column], unit="s")
+
+    return df.sort_values(by="last_access", ascending=False)
+
+
+def prune_cache(directory, max_bytes=CACHE_BUDGET_BYTES, keep=()):
+    # evict the least recently used cache files beyond max_bytes. Files that have been
+    # deleted by hand are dropped from the manifest.
+    with lock_cache_manifest(directory):
+        manifest = load_cache_manifest(directory)
+        manifest = {
+            name: entry
+            for name, entry in manifest.items()
+            if os.path.exists(os.path.join(directory, name))
+        }
+
+        total_bytes = sum(entry["size"] for entry in manifest.values())
+        for name in sorted(manifest, key=lambda name: manifest[name]["last_access"]):
+            if total_bytes <= max_bytes:
+                break
+            if name in keep:
+                continue
+
+            print("evicting " + os.path.join(directory, name) + " from the cache")
+            filename = os.path.join(directory, name)
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
+            total_bytes -= manifest.pop(name)["size"]
+
+        save_cache_manifest(directory, manifest)
+
+
+def load_metrics(filename, mmap_mode="r"):
+    # the stress arrays and tables are memory-mapped, so slicing one reporter or partner
+    # only reads that part of the file
+    index = load_metrics_index(filename)
+    traded_stress = np.load(
+        os.path.join(filename, "traded_stress.npy"), mmap_mode=mmap_mode
+    )
+    unweighted_stress = np.load(
+        os.path.join(filename, "unweighted_stress.npy"), mmap_mode=mmap_mode
+    )
+    df_stress, df_metrics = [
+        pd.DataFrame(
+            np.load(os.path.join(filename, table + ".npy"), mmap_mode=mmap_mode),
+            index=index["tables"][table]["index"],
+            columns=index["tables"][table]["columns"],
+            copy=False,
+        )
+        for table in ("df_stress", "df_metrics")
+    ]
 
     return (
-        reporter_code_list,
+        np.asarray(index["reporter_code_list"]),
         traded_stress,
         unweighted_stress,
         df_stress,
@@ -46,6 +220,12 @@ def load_metrics(filename):
     )
 
 
+def load_metrics_index(filename):
+    # reporter and partner codes, and the table labels, of a saved metrics directory
+    with open(os.path.join(filename, "index.json")) as fp:
+        return json.load(fp)
+
+
 def save_metrics(
     filename,
     reporter_code_list,
@@ -53,13 +233,84 @@ def save_metrics(
     unweighted_stress,
     df_stress,
     df_metrics,
+    partner_code_list=None,
 ):
-    with gzip.open(filename, "wb") as fp:
-        pickle.dump(reporter_code_list, fp)
-        pickle.dump(traded_stress, fp)
-        pickle.dump(unweighted_stress, fp)
-        pickle.dump(df_stress, fp)
-        pickle.dump(df_metrics, fp)
+    # one directory with raw .npy arrays, tables stored column-major, and a small index.
+    # written to a temporary directory first so a failed save never leaves a partial cache.
+    tmp_filename = filename + ".tmp"
+    if os.path.exists(tmp_filename):
+        shutil.rmtree(tmp_filename)
+    os.makedirs(tmp_filename)
+
+    np.save(os.path.join(tmp_filename, "traded_stress.npy"), traded_stress)
+    np.save(os.path.join(tmp_filename, "unweighted_stress.npy"), unweighted_stress)
+
+    index = {
+        "reporter_code_list": np.asarray(reporter_code_list).tolist(),
+        "partner_code_list": None
+        if partner_code_list is None
+        else np.asarray(partner_code_list).tolist(),
+        "tables": {},
+    }
+    for table, df in (("df_stress", df_stress), ("df_metrics", df_metrics)):
+        np.save(
+            os.path.join(tmp_filename, table + ".npy"),
+            np.asfortranarray(df.to_numpy(dtype=float)),
+        )
+        index["tables"][table] = {
+            "index": df.index.tolist(),
+            "columns": df.columns.tolist(),
+        }
+    with open(os.path.join(tmp_filename, "index.json"), "w") as fp:
+        json.dump(index, fp)
+
+    if os.path.exists(filename):
+        shutil.rmtree(filename)
+    os.rename(tmp_filename, filename)
+
+
+def get_file_hash(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def load_trade_records(filename):
+    # integer-coded rows of a GTAP trade csv, read from a binary sidecar next to the csv
+    # that is rebuilt whenever the csv's hash changes
+    sidecar = os.path.splitext(filename)[0] + ".npz"
+    csv_hash = get_file_hash(filename)
+    if os.path.exists(sidecar):
+        with np.load(sidecar) as f:
+            if str(f["csv_hash"]) == csv_hash:
+                return {key: f[key] for key in f.files}
+
+    print("building trade sidecar: " + sidecar)
+    data_trade = pd.read_csv(filename).fillna(0)
+    commodity_list, icommodity = np.unique(
+        data_trade["COMM"].values.astype(str), return_inverse=True
+    )
+    region_list, iregion = np.unique(
+        data_trade[["Source", "Destination"]].values.astype(str).T.ravel(),
+        return_inverse=True,
+    )
+    isource, idestination = np.split(iregion, 2)
+
+    records = {
+        "csv_hash": np.array(csv_hash),
+        "commodity_list": commodity_list,
+        "region_list": region_list,
+        "icommodity": icommodity.astype(np.int16),
+        "isource": isource.astype(np.int16),
+        "idestination": idestination.astype(np.int16),
+        "values": data_trade["TotValue"].values.astype(np.float64),
+    }
+    np.savez(sidecar, **records)
+
+    return records
 
 
 def load_reanalysis_data(settings, DATA_DIRECTORY, data_like=None):
@@ -73,15 +324,106 @@ def load_reanalysis_data(settings, DATA_DIRECTORY, data_like=None):
     return da
 
 
-def load_climate_data(settings, DATA_DIRECTORY):
+def load_climate_data(
+    settings, DATA_DIRECTORY, scratch_file=None, workers=1, max_in_flight=None
+):
+    # members are written into a preallocated (member, time, lat, lon) array, which is
+    # memory-mapped to scratch_file (.npy) when given. With workers > 1 the members are
+    # loaded by a process pool, with at most max_in_flight (default 2 * workers) loaded
+    # members waiting to be written at any time.
+    member_filenames = get_member_filenames(settings, DATA_DIRECTORY)
+
     da_all = None
+    for imember, da in iterate_members(
+        settings, member_filenames, workers, max_in_flight
+    ):
+        if da_all is None:
+            da_all = allocate_members(da, len(member_filenames), scratch_file)
+        da_all.values[imember] = da.values
+
+    print("    da_shape = " + str(da_all.shape))
+
+    return da_all
+
+
+def iterate_members(settings, member_filenames, workers=1, max_in_flight=None):
+    # yields (imember, da) in member order
+    if workers <= 1:
+        for imember, filenames in enumerate(member_filenames):
+            print("ensemble member = " + filenames[0])
+            yield imember, load_member(settings, filenames)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = collections.deque()
+        for imember, filenames in enumerate(member_filenames):
+            futures.append((imember, executor.submit(load_member, settings, filenames)))
+
+            # wait for the oldest member before submitting more
+            while len(futures) >= max_in_flight or (
+                futures and imember == len(member_filenames) - 1
+            ):
+                imember_done, future = futures.popleft()
+                print("ensemble member = " + member_filenames[imember_done][0])
+                yield imember_done, future.result()
+
+
+def allocate_members(da, n_members, scratch_file=None):
+    shape = (n_members,) + da.shape
+    if scratch_file is None:
+        values = np.empty(shape, dtype=da.dtype)
+    else:
+        values = np.lib.format.open_memmap(
+            scratch_file, mode="w+", dtype=da.dtype, shape=shape
+        )
+
+    return xr.DataArray(
+        values,
+        dims=("member",) + da.dims,
+        coords=da.coords,
+        name=da.name,
+        attrs=da.attrs,
+    )
+
+
+def get_member_variable(settings):
+    if settings["gcm"] == "mpi":
+        return settings["var"]
+    elif settings["gcm"] == "cesm2":
+        if settings["var"] == "tas":
+            return "TREFHT"
+        elif settings["var"] == "pr":
+            return "PRECT"
+
+    raise NotImplementedError()
+
+
+def load_member(settings, filenames):
+    # open, resample and concatenate the scenarios of one ensemble member
+    var = get_member_variable(settings)
+
+    da = []
+    for filename in filenames:
+        da_scenario = xr.open_dataset(filename)[var].squeeze()
+        da.append(da_scenario.resample(time="1M").mean())
+    da = xr.concat(da, "time")
+
+    # PROCESS THE ENSEMBLE MEMBER
+    return data_processing.process_member(settings, da)
+
+
+def get_member_filenames(settings, DATA_DIRECTORY):
+    # list of the files (scenarios) making up each ensemble member
+    member_filenames = []
 
     # MPI -----------------------
     if settings["gcm"] == "mpi":
         for ens in range(settings["n_members"]):
             # get member
             member_text = f"{ens + 1:03}"
-            print("ensemble member = " + member_text)
 
             if settings["var"] == "mrsos":
                 realm = "Lmon"
@@ -98,9 +440,6 @@ def load_climate_data(settings, DATA_DIRECTORY):
                 + member_text
                 + "i1850p3_185001-200512.nc"
             )
-            dah = xr.open_dataset(filename_hist)[settings["var"]].squeeze()
-            dah = dah.resample(time="1M").mean()
-
             filename_ssp = (
                 DATA_DIRECTORY
                 + "mpi/"
@@ -111,20 +450,7 @@ def load_climate_data(settings, DATA_DIRECTORY):
                 + member_text
                 + "i2005p3_200601-209912.nc"
             )
-            das = xr.open_dataset(filename_ssp)[settings["var"]].squeeze()
-            das = das.resample(time="1M").mean()
-
-            # CONCATENATE SCENARIOS
-            da = xr.concat([dah, das], "time")
-
-            # PROCESS THE ENSEMBLE MEMBER
-            da = data_processing.process_member(settings, da)
-
-            # CONCATENATE MEMBERS
-            if da_all is None:
-                da_all = da.expand_dims(dim="member")
-            else:
-                da_all = xr.concat([da_all, da], dim="member")
+            member_filenames.append((filename_hist, filename_ssp))
 
     # CESM2 -----------------------
     elif settings["gcm"] == "cesm2":
@@ -154,25 +480,13 @@ def load_climate_data(settings, DATA_DIRECTORY):
             1281,
             1301,
         ]
+        var = get_member_variable(settings)
 
-        break_out_flag = False
         for start_text in ("CMIP6", "smbb"):
-
-            if break_out_flag:
-                break
-
             for iy in inityears:
-
-                if break_out_flag:
-                    break
-
                 for ens in np.arange(0, 20):
                     member_text = f"{iy}.{ens + 1:03}"
                     realm = "mon"
-                    if settings["var"] == "tas":
-                        var = "TREFHT"
-                    elif settings["var"] == "pr":
-                        var = "PRECT"
 
                     filename = (
                         DATA_DIRECTORY
@@ -188,26 +502,12 @@ def load_climate_data(settings, DATA_DIRECTORY):
                     )
                     if not os.path.isfile(filename):
                         continue
-                    print(filename)
-                    da = xr.open_dataset(filename)[var].squeeze()
-                    da = da.resample(time="1M").mean()
-
-                    # PROCESS THE ENSEMBLE MEMBER
-                    da = data_processing.process_member(settings, da)
-
-                    # CONCATENATE MEMBERS
-                    if da_all is None:
-                        da_all = da.expand_dims(dim="member")
-                    else:
-                        da_all = xr.concat([da_all, da], dim="member")
+                    member_filenames.append((filename,))
 
-                    if da_all.shape[0] > settings["n_members"]:
-                        break_out_flag = True
-                        break
+                    if len(member_filenames) > settings["n_members"]:
+                        return member_filenames
 
     else:
         raise NotImplementedError()
 
-    print("    da_shape = " + str(da_all.shape))
-
-    return da_all
+    return member_filenames
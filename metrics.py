@@ -5,6 +5,8 @@ Functions
 get_metrics
 """
 import numpy as np
+import pandas as pd
+import concurrent.futures
 import scipy.stats as stats
 
 __author__ = "Elizabeth A. Barnes"
@@ -18,6 +20,46 @@ def stress_correlation(x, y):
     return r
 
 
+def rank_correlation(x, axis=-2):
+    # Spearman correlation between every pair of columns of x, batched over any leading
+    # dimensions, e.g. traded_stress (reporter, sample, partner) -> (reporter, partner, partner).
+    # The samples are ranked once and the ranks correlated with a single einsum. Columns
+    # that are entirely nan or constant give nan, and columns with some nan samples fall
+    # back to spearmanr with nan_policy="omit" so pairwise deletion matches stress_correlation.
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    is_nan = np.isnan(x)
+    complete = ~is_nan.any(axis=-1)
+
+    ranks = stats.rankdata(np.where(is_nan, 0.0, x), axis=-1)
+    ranks = ranks - ranks.mean(axis=-1, keepdims=True)
+    ranks[~complete] = 0.0
+
+    cov = np.einsum("...is,...js->...ij", ranks, ranks)
+    norm = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = cov / (norm[..., :, np.newaxis] * norm[..., np.newaxis, :])
+    corr = np.clip(corr, -1.0, 1.0)
+    corr[~(complete[..., :, np.newaxis] & complete[..., np.newaxis, :])] = np.nan
+
+    # pairwise deletion for the (rare) columns with only some missing samples
+    partial = ~complete & ~is_nan.all(axis=-1)
+    for index in zip(*np.nonzero(partial)):
+        *batch, i = index
+        for j in np.nonzero(~is_nan[tuple(batch)].all(axis=-1))[0]:
+            corr[tuple(batch) + (i, j)] = stats.spearmanr(
+                x[tuple(batch) + (i,)], x[tuple(batch) + (j,)], nan_policy="omit"
+            ).correlation
+            corr[tuple(batch) + (j, i)] = corr[tuple(batch) + (i, j)]
+
+    return corr
+
+
+def stress_correlation_matrix(traded_stress):
+    # partner x partner stress correlations for every reporter, with the stress_correlation
+    # convention that undefined correlations are 0
+    return np.nan_to_num(rank_correlation(traded_stress, axis=-2), nan=0.0)
+
+
 def correlation_localimports(traded_stress, reporter_code, partner_code_list):
     ip = np.where(partner_code_list == reporter_code)[0]
     x = traded_stress[:, ip]
@@ -62,6 +104,193 @@ def variance_fraction(traded_stress, irep, reporter_code, partner_code_list):
     return np.mean(y_noself / y), np.var(y_noself) / np.var(y)
 
 
+def get_reporter_stress(
+    traded_stress, trade_matrix, reporter_code_list, partner_code_list
+):
+    # per-sample stress series the reporter metrics are built from, from traded_stress
+    # [reporter, sample, partner] and the [reporter, partner] trade_matrix (dollars or
+    # calories). The reporter's own column is nan if the reporter is not one of the
+    # partners, and the top two partners keep ties in partner order.
+    traded_stress = np.asarray(traded_stress, dtype=float)
+    reporter_code_list = np.asarray(reporter_code_list)
+    partner_code_list = np.asarray(partner_code_list)
+    irep = np.arange(traded_stress.shape[0])
+
+    is_self = reporter_code_list[:, np.newaxis] == partner_code_list[np.newaxis, :]
+    self_stress = np.where(
+        is_self.any(axis=-1)[:, np.newaxis],
+        traded_stress[irep, :, np.argmax(is_self, axis=-1)],
+        np.nan,
+    )
+    noself_stress = np.nansum(
+        np.where(is_self[:, np.newaxis, :], 0.0, traded_stress), axis=-1
+    )
+
+    j_top = np.argsort(-np.asarray(trade_matrix), axis=-1, kind="stable")[:, :2]
+    toptwo_stress = traded_stress[irep[:, np.newaxis], :, j_top].transpose(0, 2, 1)
+
+    return {
+        "total": np.nansum(traded_stress, axis=-1),
+        "self": self_stress,
+        "noself": noself_stress,
+        "toptwo": toptwo_stress,
+    }
+
+
+def compute_reporter_metrics(
+    traded_stress,
+    trade_matrix,
+    reporter_code_list,
+    partner_code_list,
+    perc=75,
+    frac=0.1,
+):
+    # all summarizing metrics for every reporter at once
+    stress = get_reporter_stress(
+        traded_stress, trade_matrix, reporter_code_list, partner_code_list
+    )
+
+    # correlation of local stress with the stress from all other imports, and
+    # correlation between the two largest partners
+    corr_localtotal = stress_correlation_matrix(
+        np.stack((stress["self"], stress["noself"]), axis=-1)
+    )
+    corr_toptwo = stress_correlation_matrix(stress["toptwo"])
+
+    # fraction of the stress and of its variance that comes from imports
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac_stress_noself = np.mean(stress["noself"] / stress["total"], axis=-1)
+        frac_var_noself = np.var(stress["noself"] * 100, axis=-1) / np.var(
+            stress["total"] * 100, axis=-1
+        )
+
+    # local to imported stress ratios, 0 where undefined
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stress_fracratio_perc = np.nanpercentile(
+            stress["self"], perc, axis=-1
+        ) / np.percentile(stress["noself"], perc, axis=-1)
+    stress_fracratio_perc[~np.isfinite(stress_fracratio_perc)] = 0.0
+    stress_fracratio = exceedance_ratio(stress["self"], stress["noself"], frac)
+
+    return pd.DataFrame(
+        {
+            "corr_localtotal": corr_localtotal[:, 0, 1],
+            "corr_toptwo": corr_toptwo[:, 0, 1],
+            "frac_stress_noself": frac_stress_noself,
+            "frac_var_noself": frac_var_noself,
+            "stress_fracratio": stress_fracratio,
+            "stress_fracratio_perc": stress_fracratio_perc,
+        },
+        index=np.asarray(reporter_code_list),
+    )
+
+
+def exceedance_ratio(rep_stress, total_stress, frac):
+    # ratio of the number of samples at or above frac along the last axis, 0 where the
+    # denominator never exceeds frac
+    n_total = np.count_nonzero(total_stress >= frac, axis=-1)
+    n_rep = np.count_nonzero(rep_stress >= frac, axis=-1)
+    return np.where(n_total == 0, 0.0, n_rep / np.maximum(n_total, 1))
+
+
+def get_bootstrap_samples(n_samples, settings, n_boot=1000, n_windows=None):
+    # seeded [replicate, sample] index matrix, drawn once, that resamples whole ensemble
+    # members. Samples are stacked member by member (see climatedata.get_climate_data), so
+    # every member contributes its n_windows consecutive samples. The number of members
+    # is taken from the data, since e.g. CESM2 loads more than settings["n_members"].
+    if n_windows is None:
+        n_windows = (
+            settings["response_year_range"][1] - settings["response_year_range"][0] + 1
+        ) // settings["window_len"]
+    if n_samples % n_windows != 0:
+        raise ValueError(
+            f"{n_samples} samples are not whole members of {n_windows} windows"
+        )
+    n_members = n_samples // n_windows
+
+    rng = np.random.default_rng(settings["rng_seed"])
+    imember = rng.integers(0, n_members, size=(n_boot, n_members))
+    isample = imember[:, :, np.newaxis] * n_windows + np.arange(n_windows)
+
+    return isample.reshape(n_boot, n_samples)
+
+
+def evaluate_bootstrap(stress, isample, frac=0.1, batch_size=100):
+    # metrics for every [replicate, reporter], gathering the per-sample stress of
+    # get_reporter_stress for batch_size replicates at a time
+    replicates = {}
+    for ibatch in range(0, isample.shape[0], batch_size):
+        # gathered series are [replicate, reporter, sample(, partner)]
+        gathered = {
+            key: np.moveaxis(value[:, isample[ibatch : ibatch + batch_size]], 1, 0)
+            for key, value in stress.items()
+        }
+        batch = {
+            "total_stress": np.mean(gathered["total"], axis=-1),
+            "exceedance_frac": np.mean(gathered["total"] >= frac, axis=-1),
+            "corr_localtotal": stress_correlation_matrix(
+                np.stack((gathered["self"], gathered["noself"]), axis=-1)
+            )[..., 0, 1],
+            "corr_toptwo": stress_correlation_matrix(gathered["toptwo"])[..., 0, 1],
+            "stress_fracratio": exceedance_ratio(
+                gathered["self"], gathered["noself"], frac
+            ),
+        }
+        for key, value in batch.items():
+            replicates.setdefault(key, []).append(value)
+
+    return {key: np.concatenate(value, axis=0) for key, value in replicates.items()}
+
+
+def bootstrap_metrics(
+    traded_stress,
+    trade_matrix,
+    reporter_code_list,
+    partner_code_list,
+    settings,
+    n_boot=1000,
+    n_windows=None,
+    frac=0.1,
+    ci=(2.5, 97.5),
+    batch_size=100,
+    workers=1,
+):
+    # confidence intervals on the mean total stress, the exceedance fraction of frac, the
+    # correlation metrics and the stress fraction ratio from resampling ensemble members.
+    # The resampling indices are drawn once from settings["rng_seed"] and split into
+    # contiguous blocks of replicates, so the results do not depend on workers.
+    stress = get_reporter_stress(
+        traded_stress, trade_matrix, reporter_code_list, partner_code_list
+    )
+    isample = get_bootstrap_samples(
+        stress["total"].shape[-1], settings, n_boot=n_boot, n_windows=n_windows
+    )
+
+    if workers <= 1:
+        replicates = evaluate_bootstrap(stress, isample, frac, batch_size)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            block_list = list(
+                executor.map(
+                    evaluate_bootstrap,
+                    [stress] * workers,
+                    np.array_split(isample, workers),
+                    [frac] * workers,
+                    [batch_size] * workers,
+                )
+            )
+        replicates = {
+            key: np.concatenate([block[key] for block in block_list], axis=0)
+            for key in block_list[0]
+        }
+
+    df_ci = pd.DataFrame(index=np.asarray(reporter_code_list))
+    for key, value in replicates.items():
+        df_ci[key + "_low"], df_ci[key + "_high"] = np.percentile(value, ci, axis=0)
+
+    return df_ci, replicates
+
+
 # ORIGINAL VERSION OF CODE
 # def variance_fraction(traded_stress, irep, reporter_code, partner_code_list):
 #     y = np.nansum(traded_stress[irep, :, :] * 100, axis=-1)
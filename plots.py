@@ -17,6 +17,7 @@ import cartopy.feature as cfeature
 import palettable
 from matplotlib.colors import ListedColormap
 import data_processing
+import metrics
 from scipy.cluster.hierarchy import dendrogram
 
 mpl.rcParams["figure.facecolor"] = "white"
@@ -220,9 +221,8 @@ def plot_import_cov(
     partner_response_vector,
     trade_data_year,
     trade_summary=False,
+    top_n=5,
 ):
-    import scipy.stats as stats
-
     cmap = ListedColormap(palettable.scientific.diverging.Roma_10_r.mpl_colors)
     cmap.set_bad(color="white", alpha=0.8)
 
@@ -231,14 +231,14 @@ def plot_import_cov(
         top_partners = data_trade
         TOP_N = len(top_partners)
     else:
-        TOP_N = 5
+        TOP_N = top_n
         top_partners = data_trade.sort_values(by="TotValue", ascending=False)[:TOP_N]
         print(top_partners)
         x = partner_response_vector[:, top_partners.index.values]
     x = np.insert(x, 0, reporter_response_vector, axis=1)
 
     print(x.shape)
-    cov = stats.spearmanr(x).correlation
+    cov = metrics.rank_correlation(x)
     cov = remove_offdiagonal(cov)
 
     plt.pcolormesh(np.ma.masked_invalid(cov), edgecolors="k", linewidths=4, cmap=cmap)
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import cropstress
+import experiment_settings
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    # r imports only from p, whose supply partly comes back from r
+    pd.DataFrame(
+        [
+            ("wht", "p", "p", 10.0),
+            ("wht", "r", "p", 5.0),
+            ("wht", "p", "r", 5.0),
+            ("wht", "r", "r", 5.0),
+        ],
+        columns=["COMM", "Source", "Destination", "TotValue"],
+    ).to_csv(tmp_path / "trade.csv", index=False)
+    monkeypatch.setattr(cropstress, "GTAP_DATA_DIRECTORY", str(tmp_path) + "/")
+    monkeypatch.setattr(cropstress, "_TRADE_CUBES", {})
+
+    return {
+        "gtap_filename": "trade.csv",
+        "trade_data_year": 2017,
+        "product": "wht",
+        "include_self": False,
+        "exclude_regions": (),
+    }
+
+
+@pytest.mark.parametrize("trade_hops", [2, 5, "converge"])
+def test_origin_shares_without_self(settings, trade_hops):
+    settings["trade_hops"] = trade_hops
+    __, reporter_code_list, __, trade_matrix, partner_code_list = (
+        cropstress.get_trade_data(settings, return_matrix=True)
+    )
+    origin_shares = cropstress.get_origin_shares(
+        trade_matrix, reporter_code_list, partner_code_list, settings
+    )
+
+    is_self = reporter_code_list[:, np.newaxis] == partner_code_list[np.newaxis, :]
+    np.testing.assert_array_equal(origin_shares[is_self], 0.0)
+    np.testing.assert_allclose(np.sum(origin_shares, axis=-1), 1.0)
+
+
+def test_metrics_filename_single_hop():
+    settings = experiment_settings.get_settings("exp601")
+    filename = cropstress.get_metrics_filename(settings)
+
+    assert cropstress.get_metrics_filename(dict(settings, trade_hops=1)) == filename
+    assert cropstress.get_metrics_filename(dict(settings, trade_hops=2)) != filename
+
+
+def test_build_trade_scenarios_unknown_codes():
+    codes = np.array(["p", "r"])
+    with pytest.raises(NameError, match="partners"):
+        cropstress.build_trade_scenarios(codes, codes, [{"remove": ("x",)}])
+    with pytest.raises(NameError, match="reporters"):
+        cropstress.build_trade_scenarios(codes, codes, [{"reporters": ("x",)}])
+
+
+def test_evaluate_trade_scenarios_without_climate_data(settings, tmp_path, monkeypatch):
+    monkeypatch.setattr(cropstress, "PROCESSED_DIRECTORY", str(tmp_path) + "/")
+    settings = dict(experiment_settings.get_settings("exp601"), **settings)
+    factors, reallocate = cropstress.build_trade_scenarios(
+        np.array(["p", "r"]), np.array(["p", "r"]), [{}]
+    )
+    with pytest.raises(ValueError, match="climate data"):
+        cropstress.evaluate_trade_scenarios(settings, factors, reallocate)
@@ -0,0 +1,71 @@
+import numpy as np
+import xarray as xr
+import geopandas as gpd
+import shapely
+import pytest
+
+import data_processing
+
+
+def get_regions():
+    return gpd.GeoDataFrame(
+        {"REG": ["usa", "can", "mex"]},
+        geometry=[shapely.box(x, 0, x + 1, 1) for x in range(3)],
+    )
+
+
+def test_map_to_shapefile_filtered_copy():
+    regs_shp = get_regions()
+    assert data_processing.map_to_shapefile(regs_shp, "mex") == 2
+
+    subset = regs_shp[regs_shp["REG"] != "usa"].reset_index(drop=True)
+    assert data_processing.map_to_shapefile(subset, "mex") == 1
+    assert data_processing.map_to_shapefile(regs_shp, "mex") == 2
+
+
+def test_closest_gridpoint_reordered_copy():
+    regs_shp = get_regions()
+    data_processing.get_region_lookup(regs_shp, centroids=True)
+
+    reordered = regs_shp.iloc[::-1].reset_index(drop=True)
+    centroid = data_processing.get_region_lookup(reordered, centroids=True)["centroid"]
+    assert centroid["usa"] == (0.5, 0.5)
+    assert data_processing.get_region_lookup(reordered)["index"]["usa"] == 2
+
+
+def test_regrid_sum_below_grid():
+    # the source point south of the first target row goes into that row, not the last
+    da_grid = xr.DataArray(
+        np.zeros((3, 4)),
+        dims=("lat", "lon"),
+        coords={"lat": [-60.0, 0.0, 60.0], "lon": [0.0, 90.0, 180.0, 270.0]},
+    )
+    da = xr.DataArray(
+        [[1.0, 2.0], [4.0, 8.0]],
+        dims=("lat", "lon"),
+        coords={"lat": [-80.0, 70.0], "lon": [-10.0, 100.0]},
+    )
+    da_regrid = data_processing.regrid_sum(da, da_grid)
+
+    expected = np.zeros((3, 4))
+    expected[0, 3], expected[0, 1] = 1.0, 2.0
+    expected[2, 3], expected[2, 1] = 4.0, 8.0
+    np.testing.assert_array_equal(da_regrid.values, expected)
+
+
+def test_grid_spec_without_archive(tmp_path, monkeypatch):
+    grid_file = str(tmp_path / "wht_mpi_regrid.nc")
+    xr.DataArray(
+        np.zeros((3, 4)),
+        dims=("lat", "lon"),
+        coords={"lat": [-60.0, 0.0, 60.0], "lon": [0.0, 90.0, 180.0, 270.0]},
+    ).to_netcdf(grid_file)
+    monkeypatch.setattr(data_processing, "GCM_GRIDS", {})
+    monkeypatch.setattr(data_processing, "GCM_GRID_FILES", {"mpi": grid_file})
+
+    lat, lon = data_processing.get_grid_spec("mpi", str(tmp_path / "archive") + "/")
+    np.testing.assert_array_equal(lat, [-60.0, 0.0, 60.0])
+    np.testing.assert_array_equal(lon, [0.0, 90.0, 180.0, 270.0])
+
+    with pytest.raises(ValueError, match="unknown grid"):
+        data_processing.get_grid_spec("cesm2", str(tmp_path / "archive") + "/")
@@ -0,0 +1,44 @@
+import os
+
+import file_handling
+
+
+def test_cache_key_ignores_input_files(tmp_path):
+    input_file = str(tmp_path / "member.nc")
+    settings = {"exp_name": "exp1", "gcm": "mpi"}
+    filename = file_handling.get_cache_filename(
+        str(tmp_path) + "/", settings, ("gcm",), ".nc", inputs=(input_file,)
+    )
+
+    with open(input_file, "w") as fp:
+        fp.write("data")
+    assert (
+        file_handling.get_cache_filename(
+            str(tmp_path) + "/",
+            dict(settings, exp_name="exp2"),
+            ("gcm",),
+            ".nc",
+            inputs=(input_file,),
+        )
+        == filename
+    )
+
+
+def test_cache_current_only_checks_present_inputs(tmp_path):
+    input_file = str(tmp_path / "member.nc")
+    with open(input_file, "w") as fp:
+        fp.write("data")
+    filename = str(tmp_path / "cache.nc")
+    with open(filename, "w") as fp:
+        fp.write("cache")
+    file_handling.register_cache(
+        filename, {"exp_name": "exp1"}, None, input_files=(input_file,)
+    )
+    assert file_handling.is_cache_current(filename)
+
+    with open(input_file, "a") as fp:
+        fp.write(" changed")
+    assert not file_handling.is_cache_current(filename)
+
+    os.remove(input_file)
+    assert file_handling.is_cache_current(filename)
@@ -0,0 +1,23 @@
+import numpy as np
+
+import experiment_settings
+import metrics
+
+
+def test_bootstrap_samples_cesm2_members():
+    # CESM2 loads n_members + 1 members, each contributing n_windows stacked samples
+    settings = dict(
+        experiment_settings.get_settings("exp400"),
+        response_year_range=(2021, 2030),
+        window_len=2,
+    )
+    n_windows = 5
+    n_members = settings["n_members"] + 1
+    isample = metrics.get_bootstrap_samples(n_members * n_windows, settings, n_boot=20)
+
+    assert isample.shape == (20, n_members * n_windows)
+    blocks = isample.reshape(20, n_members, n_windows)
+    np.testing.assert_array_equal(blocks[:, :, 0] % n_windows, 0)
+    np.testing.assert_array_equal(np.diff(blocks, axis=-1), 1)
+    imember = blocks[:, :, 0] // n_windows
+    assert imember.min() >= 0 and imember.max() == n_members - 1